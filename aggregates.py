@@ -0,0 +1,120 @@
+import datetime
+from collections import deque
+from base import Chat, Meal, async_session
+from shards import owned
+
+DAY = datetime.timedelta(days=1)
+
+
+class MealWindow:
+    """Meals newer than `length` with a running sum and count.
+
+    Meals mostly arrive in time order, so adding and expiring are O(1)
+    amortized; a back-dated meal is inserted at its place from the right.
+    """
+
+    def __init__(self, length):
+        self.length = length
+        self.meals = deque()
+        self.sum = 0
+        self.count = 0
+
+    def add(self, time, amount, now):
+        if time + self.length <= now:
+            return
+        i = len(self.meals)
+        while i > 0 and self.meals[i - 1][0] > time:
+            i -= 1
+        self.meals.insert(i, (time, amount))
+        self.sum += amount
+        self.count += 1
+
+    def expire(self, now):
+        while self.meals and self.meals[0][0] + self.length <= now:
+            _, amount = self.meals.popleft()
+            self.sum -= amount
+            self.count -= 1
+
+
+class MealAggregate:
+    def __init__(self, period, last_meal=None):
+        self.last_meal = last_meal
+        self.day = MealWindow(DAY)
+        self.period = MealWindow(period) if period is not None else None
+
+    def windows(self):
+        return [window for window in (self.day, self.period) if window is not None]
+
+    def length(self):
+        return max(window.length for window in self.windows())
+
+    def add(self, time, amount, now):
+        if self.last_meal is None or time > self.last_meal:
+            self.last_meal = time
+        for window in self.windows():
+            window.add(time, amount, now)
+
+    def expire(self, now):
+        for window in self.windows():
+            window.expire(now)
+
+    def period_sum(self):
+        return 0 if self.period is None else self.period.sum
+
+
+_aggregates = {}
+
+
+def loaded(chat_id):
+    return chat_id in _aggregates
+
+
+def get(chat_id):
+    aggregate = _aggregates[chat_id]
+    aggregate.expire(datetime.datetime.utcnow())
+    return aggregate
+
+
+def add_meal(chat_id, time, amount):
+    if chat_id in _aggregates:
+        _aggregates[chat_id].add(time, amount, datetime.datetime.utcnow())
+
+
+def drop(chat_id):
+    _aggregates.pop(chat_id, None)
+
+
+def _load(session, chat_id=None):
+    now = datetime.datetime.utcnow()
+    chats = session.query(Chat)
+    if chat_id is not None:
+        chats = chats.filter(Chat.id == chat_id)
+    else:
+        chats = chats.filter(owned(Chat.id))
+
+    aggregates = {}
+    for chat in chats:
+        period = chat.period_time() if chat.period is not None else None
+        aggregates[chat.id] = MealAggregate(period, chat.last_meal)
+    if not aggregates:
+        return aggregates
+
+    # only the columns and the time range the windows can hold
+    length = max(aggregate.length() for aggregate in aggregates.values())
+    meals = session.query(Meal.chat_id, Meal.time, Meal.amount) \
+        .filter(Meal.time > now - length) \
+        .order_by(Meal.time)
+    if chat_id is not None:
+        meals = meals.filter(Meal.chat_id == chat_id)
+    else:
+        meals = meals.filter(owned(Meal.chat_id))
+    for _chat_id, time, amount in meals:
+        if _chat_id in aggregates:
+            aggregates[_chat_id].add(time, amount, now)
+    return aggregates
+
+
+async def reload(chat_id):
+    aggregates = await async_session(_load)(chat_id)
+    drop(chat_id)
+    _aggregates.update(aggregates)
@@ -0,0 +1,85 @@
+"""Feeding statistics computed over a chat's meals as numpy arrays.
+
+numpy is only imported here, and bot.py imports this module on the first
+statistics command, so starting the bot does not pay for it.
+"""
+import datetime
+import itertools
+from collections import namedtuple
+import numpy as np
+from sqlalchemy import func, cast, Integer
+from base import async_session, Meal, MealDay
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+# unix seconds and amounts of the meals in time order, and of the days
+# retention.py has rolled up, which only count towards daily totals
+Feedings = namedtuple('Feedings', 'times amounts rolled_days rolled_amounts')
+
+
+def _seconds(column):
+    return cast(func.strftime('%s', column), Integer)
+
+
+def _columns(rows):
+    # np.array() over sqlalchemy rows takes longer than the query itself
+    array = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64, count=2 * len(rows)).reshape(-1, 2)
+    return array[:, 0], array[:, 1]
+
+
+@async_session
+def load(session, chat_id, since):
+    """Feedings of a chat after the since datetime, in two queries."""
+    meals = session.query(_seconds(Meal.time), Meal.amount) \
+        .filter(Meal.chat_id == chat_id) \
+        .filter(Meal.time > since) \
+        .order_by(Meal.time) \
+        .all()
+    days = session.query(_seconds(MealDay.day), MealDay.amount) \
+        .filter(MealDay.chat_id == chat_id) \
+        .filter(MealDay.day >= since.date()) \
+        .all()
+    return Feedings(*_columns(meals), *_columns(days))
+
+
+def _timestamp(now):
+    return int(now.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def _sum_by(index, weights, length):
+    keep = (index >= 0) & (index < length)
+    return np.bincount(index[keep], weights=weights[keep], minlength=length).astype(np.int64)
+
+
+def daily(feedings, now, days):
+    """Amount per day, index 0 is the last 24 hours like daily_meal_totals()."""
+    now = _timestamp(now)
+    # rolled up days count from their midnight
+    return _sum_by((now - feedings.times) // DAY, feedings.amounts, days) + \
+        _sum_by((now - feedings.rolled_days) // DAY, feedings.rolled_amounts, days)
+
+
+def weekly(feedings, now, weeks):
+    """Amount per 7 days, index 0 is the last week."""
+    return daily(feedings, now, weeks * 7).reshape(weeks, 7).sum(axis=1)
+
+
+def hourly(feedings):
+    """Feedings and amount per UTC hour of the day."""
+    hours = feedings.times % DAY // HOUR
+    return np.bincount(hours, minlength=24), np.bincount(hours, weights=feedings.amounts, minlength=24).astype(np.int64)
+
+
+def intervals(feedings, percentiles):
+    """Percentiles of the seconds between consecutive feedings, None with fewer than two."""
+    if len(feedings.times) < 2:
+        return None
+    return np.percentile(np.diff(feedings.times), percentiles)
+
+
+def rolling_average(values, window):
+    """Means of every window consecutive values, values in time order."""
+    if len(values) < window:
+        return np.zeros(0)
+    return np.convolve(values, np.ones(window) / window, mode='valid')
@@ -1,31 +1,52 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime
+from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Date, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, func, cast, literal, event
+from sqlalchemy.pool import QueuePool
 from contextlib import contextmanager
+from metrics import watch_engine
+from concurrent.futures import ThreadPoolExecutor
+import os
+import asyncio
+import contextvars
 import datetime
+import functools
 
 Base = declarative_base()
 
+
+def alarm_time(last_meal, period):
+    if period is None or last_meal is None:
+        return None
+    return last_meal + datetime.timedelta(seconds=period)
+
+
 class Notify(Base):
     __tablename__ = 'notify'
     id = Column(Integer, primary_key=True, unique=True)
-    chat_id = Column(Integer, ForeignKey('chats_v1.id'))
+    chat_id = Column(Integer, ForeignKey('chats_v1.id'), index=True)
     message = Column(String)
     period = Column(Integer)
     last_time = Column(DateTime)
+    next_time = Column(DateTime, index=True)
 
     chat = relationship('Chat', back_populates='notifies')
 
     def period_time(self):
         return datetime.timedelta(seconds=1) * self.period
 
+    def reschedule(self, last_time):
+        self.last_time = last_time
+        self.next_time = last_time + self.period_time()
+
 
 class Chat(Base):
     __tablename__ = 'chats_v1'
     id = Column(Integer, primary_key=True, unique=True)
     period = Column(Integer)
     state = Column(String)
+    last_meal = Column(DateTime)
+    next_alarm = Column(DateTime, index=True)
     meals = relationship('Meal', back_populates='chat')
     topics = relationship('Topic', back_populates='chat')
     messages = relationship('Message', back_populates='chat')
@@ -34,10 +55,13 @@ class Chat(Base):
     def period_time(self):
         return datetime.timedelta(seconds=1) * self.period
 
+    def update_alarm(self):
+        self.next_alarm = alarm_time(self.last_meal, self.period)
+
 
 class Topic(Base):
     __tablename__ = 'topics'
-    id = Column(String, primary_key=True, unique=True)
+    id = Column(Integer, primary_key=True, unique=True)
     chat_id = Column(Integer, ForeignKey('chats_v1.id'))
     name = Column(String)
     chat = relationship(Chat, back_populates='topics')
@@ -52,13 +76,24 @@ class Meal(Base):
     chat_id = Column(Integer, ForeignKey('chats_v1.id'))
     chat = relationship(Chat, back_populates='meals')
 
+    __table_args__ = (Index('ix_meals_chat_id_time', 'chat_id', 'time'),)
+
+
+# meals older than the retention period, summed up per chat and UTC day
+class MealDay(Base):
+    __tablename__ = 'meal_days'
+    chat_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    amount = Column(Integer)
+    count = Column(Integer)
+
 
 class Message(Base):
     __tablename__ = 'messages_v1'
     id = Column(Integer, primary_key=True, unique=True)
     telegram_id = Column(Integer)
     chat_id = Column(Integer, ForeignKey('chats_v1.id'))
-    topic_id = Column(String, ForeignKey('topics.id'))
+    topic_id = Column(Integer, ForeignKey('topics.id'))
 
     content = Column(String)
     time = Column(DateTime)
@@ -66,20 +101,193 @@ class Message(Base):
     topic = relationship(Topic, back_populates='messages')
     chat = relationship(Chat, back_populates='messages')
 
+    __table_args__ = (Index('ix_messages_v1_chat_id_topic_id', 'chat_id', 'topic_id'),)
+
+
+class Mute(Base):
+    __tablename__ = 'mutes'
+    chat_id = Column(Integer, primary_key=True)
+    until = Column(DateTime, index=True)
+
+
+class ForwardJob(Base):
+    __tablename__ = 'forward_jobs'
+    chat_id = Column(Integer, primary_key=True)
+    topic_id = Column(Integer, primary_key=True)
+    last_message_id = Column(Integer)
+    forwarded = Column(Integer)
+    total = Column(Integer)
+
 
 Session = None
 Engine = None
+Executor = None
 
+# only sqlite is supported: stats use its date functions, /search its FTS5
+# index, history.py its upserts and migrations its user_version
+DB_URL = os.environ.get('NANNYBOT_DB_URL', 'sqlite:///chats.db')
+DB_POOL_SIZE = int(os.environ.get('NANNYBOT_DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('NANNYBOT_DB_MAX_OVERFLOW', 5))
+DB_POOL_TIMEOUT = int(os.environ.get('NANNYBOT_DB_POOL_TIMEOUT', 30))
+# 'tuned' or 'default', the latter is the plain engine for comparison
+DB_PROFILE = os.environ.get('NANNYBOT_DB_PROFILE', 'tuned')
+# sqlite serializes writers anyway, one thread also keeps sessions in submit order
+DB_THREADS = int(os.environ.get('NANNYBOT_DB_THREADS', 1))
 
-def start_engine():
+# stored in sqlite's user_version, bump it whenever the models or migrate() change
+SCHEMA_VERSION = 3
+
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    # with WAL a commit no longer fsyncs, only checkpoints do
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 256 * 1024 * 1024),
+    # negative means KiB
+    ('cache_size', -64 * 1024),
+    ('busy_timeout', 5000),
+    ('temp_store', 'MEMORY'),
+]
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS:
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
+
+def _create_engine(url, profile):
+    if not url.startswith('sqlite'):
+        raise ValueError('NANNYBOT_DB_URL must be a sqlite url, got %r' % (url,))
+    if profile != 'tuned':
+        return create_engine(url, connect_args={'check_same_thread': False})
+
+    engine = create_engine(url,
+                           connect_args={'check_same_thread': False},
+                           poolclass=QueuePool,
+                           pool_size=DB_POOL_SIZE,
+                           max_overflow=DB_MAX_OVERFLOW,
+                           pool_timeout=DB_POOL_TIMEOUT)
+    event.listen(engine, 'connect', _set_sqlite_pragmas)
+    return engine
+
+
+def _schema_version():
+    with Engine.connect() as conn:
+        return conn.exec_driver_sql('PRAGMA user_version').scalar()
+
+
+def _set_schema_version():
+    with Engine.begin() as conn:
+        conn.exec_driver_sql('PRAGMA user_version = %d' % (SCHEMA_VERSION,))
+
+
+def start_engine(url=None, profile=None):
     global Session
     global Engine
-    Engine = create_engine('sqlite:///chats.db', connect_args={'check_same_thread': False})
-    Base.metadata.create_all(Engine)
+    if Engine is not None:
+        Engine.dispose()
+    Engine = _create_engine(url or DB_URL, profile or DB_PROFILE)
+    watch_engine(Engine)
     Base.metadata.bind = Engine
-
     Session = sessionmaker(bind=Engine)
 
+    # a file stamped with the current version needs no schema inspection at all
+    if _schema_version() != SCHEMA_VERSION:
+        Base.metadata.create_all(Engine)
+        migrate()
+        _set_schema_version()
+
+
+def _executor():
+    global Executor
+    if Executor is None:
+        Executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix='db')
+    return Executor
+
+
+def _add_columns(table, names):
+    existing = {column['name'] for column in inspect(Engine).get_columns(table.name)}
+    added = []
+    for name in names:
+        if name in existing:
+            continue
+        column = table.columns[name]
+        with Engine.begin() as conn:
+            conn.exec_driver_sql('ALTER TABLE %s ADD COLUMN %s %s' % (table.name, name, column.type.compile(Engine.dialect)))
+        added.append(name)
+    return added
+
+
+def _uuid_topic_ids():
+    for column in inspect(Engine).get_columns(Topic.__tablename__):
+        if column['name'] == 'id':
+            return not isinstance(column['type'], Integer)
+    return False
+
+
+def _migrate_topic_ids():
+    """Replaces the uuid topic ids of SCHEMA_VERSION 1 with integers. The
+    rowid a topic had becomes its id, so sqlite only."""
+    tables = [Topic.__table__, Message.__table__, ForwardJob.__table__]
+    with Engine.begin() as conn:
+        # pysqlite would commit before every CREATE and DROP otherwise
+        conn.exec_driver_sql('BEGIN')
+        for table in tables:
+            for index in table.indexes:
+                conn.exec_driver_sql('DROP INDEX IF EXISTS %s' % (index.name,))
+            conn.exec_driver_sql('ALTER TABLE %s RENAME TO %s_uuid' % (table.name, table.name))
+            table.create(conn)
+        conn.exec_driver_sql('INSERT INTO topics (id, chat_id, name) '
+                             'SELECT rowid, chat_id, name FROM topics_uuid')
+        conn.exec_driver_sql('INSERT INTO messages_v1 (id, telegram_id, chat_id, topic_id, content, time) '
+                             'SELECT m.id, m.telegram_id, m.chat_id, t.rowid, m.content, m.time '
+                             'FROM messages_v1_uuid m LEFT JOIN topics_uuid t ON t.id = m.topic_id')
+        conn.exec_driver_sql('INSERT INTO forward_jobs (chat_id, topic_id, last_message_id, forwarded, total) '
+                             'SELECT j.chat_id, t.rowid, j.last_message_id, j.forwarded, j.total '
+                             'FROM forward_jobs_uuid j JOIN topics_uuid t ON t.id = j.topic_id')
+        # '1 <uuid>' was a chat adding messages to a topic, see ChatState.store()
+        conn.exec_driver_sql("UPDATE chats_v1 SET state = "
+                             "(SELECT t.rowid * 2 + 1 FROM topics_uuid t WHERE t.id = substr(chats_v1.state, 3)) "
+                             "WHERE state LIKE '1 %'")
+
+        # archived messages keep their topic id, only committed if they got rewritten too
+        import retention
+        retention.renumber_topics(dict(conn.exec_driver_sql('SELECT id, rowid FROM topics_uuid').all()))
+
+        for table in reversed(tables):
+            conn.exec_driver_sql('DROP TABLE %s_uuid' % (table.name,))
+    # hand the pages of the old tables and indexes back
+    with Engine.connect() as conn:
+        conn.exec_driver_sql('VACUUM')
+
+
+def migrate():
+    # chats.db files created before the due columns existed
+    if _add_columns(Notify.__table__, ['next_time']):
+        with make_session() as session:
+            for notify in session.query(Notify):
+                if notify.last_time is not None and notify.period is not None:
+                    notify.reschedule(notify.last_time)
+
+    if _add_columns(Chat.__table__, ['last_meal', 'next_alarm']):
+        with make_session() as session:
+            last_meals = dict(session.query(Meal.chat_id, func.max(Meal.time)).group_by(Meal.chat_id))
+            for chat in session.query(Chat):
+                chat.last_meal = last_meals.get(chat.id)
+                chat.update_alarm()
+
+    if _uuid_topic_ids():
+        _migrate_topic_ids()
+
+    import search
+    search.create_index(Engine)
+
+    # create_all only indexes tables it creates itself
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(Engine, checkfirst=True)
+
 
 def drop_all():
     Base.metadata.drop_all(bind=Engine)
@@ -91,6 +299,34 @@ def drop(tables):
         Base.metadata.tables[name].drop()
 
 
+# sqlite before 3.32 allows 999 bound parameters per statement
+IN_CHUNK = 900
+
+
+def chunks(values, size=IN_CHUNK):
+    """Splits values for IN (...) filters."""
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def daily_meal_totals(session, chat_id, now, days):
+    day = cast(func.julianday(literal(now, DateTime)) - func.julianday(Meal.time), Integer)
+    rows = session.query(day, func.sum(Meal.amount)) \
+        .filter(Meal.chat_id == chat_id) \
+        .filter(Meal.time > now - datetime.timedelta(days=days)) \
+        .group_by(day)
+    # rolled up days count from their midnight
+    rolled_day = cast(func.julianday(literal(now, DateTime)) - func.julianday(MealDay.day), Integer)
+    rolled_rows = session.query(rolled_day, MealDay.amount) \
+        .filter(MealDay.chat_id == chat_id) \
+        .filter(MealDay.day >= (now - datetime.timedelta(days=days)).date())
+    result = [0] * days
+    for day, amount in rows.all() + rolled_rows.all():
+        if 0 <= day < days:
+            result[day] += amount
+    return result
+
+
 @contextmanager
 def make_session():
     session = Session()
@@ -109,3 +345,21 @@ def with_session(func):
         with make_session() as session:
             return func(session, *args, **kwargs)
     return result
+
+
+async def run_in_session(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # run_in_executor does not carry contextvars over, metrics need them
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_executor(), context.run, functools.partial(with_session(func), *args, **kwargs))
+
+
+def async_session(func):
+    """Like with_session, but runs func in the db thread and returns an awaitable.
+
+    ORM objects expire on commit, so func should return plain values.
+    """
+    @functools.wraps(func)
+    async def result(*args, **kwargs):
+        return await run_in_session(func, *args, **kwargs)
+    return result
@@ -0,0 +1,209 @@
+"""Latency of the bot handlers and of checker against a seeded database.
+
+    python -m bench.handlers [--chats 10000] [--meals 100] [--calls 200] [--db PATH]
+
+Seeds PATH (a fresh temporary file by default) with --chats chats, each
+with --meals meals spread over the last year, a notify and a topic, then
+imports bot with a stub Telegram bot and calls the handlers directly with
+synthetic updates. Nothing goes over the network.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import tempfile
+from collections import defaultdict
+
+from sqlalchemy import event
+from telegram import Update, Message as TgMessage, Chat as TgChat, User, CallbackQuery
+
+import base
+from base import Chat, Meal, Notify, Topic, Message
+
+SEED_CHUNK = 10000
+MEAL_PERIOD = 3 * 60 * 60
+
+
+def _chunks(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == SEED_CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def seed(chats, meals):
+    now = datetime.datetime.utcnow()
+    year = datetime.timedelta(days=365)
+
+    def chat_rows():
+        for _id in range(1, chats + 1):
+            # every chat is overdue, so checker has work to do
+            last_meal = now - datetime.timedelta(hours=4)
+            yield {'id': _id, 'period': MEAL_PERIOD, 'state': '', 'last_meal': last_meal,
+                   'next_alarm': base.alarm_time(last_meal, MEAL_PERIOD)}
+
+    def meal_rows():
+        for _id in range(1, chats + 1):
+            for i in range(meals):
+                yield {'chat_id': _id, 'amount': random.randint(50, 200),
+                       'time': now - datetime.timedelta(hours=4) - year * i / meals}
+
+    def notify_rows():
+        for _id in range(1, chats + 1):
+            yield {'chat_id': _id, 'message': 'vitamins', 'period': 24 * 60 * 60,
+                   'last_time': now - datetime.timedelta(days=1), 'next_time': now}
+
+    def topic_rows():
+        for _id in range(1, chats + 1):
+            yield {'id': _id, 'chat_id': _id, 'name': 'notes'}
+
+    def message_rows():
+        for _id in range(1, chats + 1):
+            for i in range(10):
+                yield {'telegram_id': i, 'chat_id': _id, 'topic_id': _id,
+                       'content': 'note %d' % i, 'time': now}
+
+    for model, rows in ((Chat, chat_rows()), (Meal, meal_rows()), (Notify, notify_rows()),
+                        (Topic, topic_rows()), (Message, message_rows())):
+        for chunk in _chunks(rows):
+            with base.Engine.begin() as conn:
+                conn.execute(model.__table__.insert(), chunk)
+
+
+class StubBot:
+    """Answers the Bot API calls the handlers make without any network."""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls += 1
+
+    async def forward_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        self.calls += 1
+
+    async def edit_message_reply_markup(self, chat_id, message_id, **kwargs):
+        self.calls += 1
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._executed)
+
+    def _executed(self, *args):
+        self.count += 1
+
+
+_user = User(1, 'bench', False)
+_update_id = 0
+
+
+def _message(chat_id, text):
+    global _update_id
+    _update_id += 1
+    return TgMessage(_update_id, datetime.datetime.now(datetime.timezone.utc),
+                     TgChat(chat_id, 'group'), from_user=_user, text=text)
+
+
+def message_update(chat_id, text):
+    return Update(_update_id + 1, message=_message(chat_id, text))
+
+
+def callback_update(chat_id, data):
+    message = _message(chat_id, None)
+    return Update(_update_id, callback_query=CallbackQuery(str(_update_id), _user, 'bench', message=message, data=data))
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def run(bot, args, counter):
+    await bot.warm_up()
+    chats = list(range(1, args.chats + 1))
+    cases = [
+        ('callback', bot.callback, lambda _id: message_update(_id, str(random.randint(50, 200)))),
+        ('stats', bot.stats, lambda _id: message_update(_id, '/stats')),
+        ('stats_month', bot.stats_month, lambda _id: message_update(_id, '/stats_month')),
+        ('stats_week', bot.stats_week, lambda _id: message_update(_id, '/stats_week')),
+        ('stats_hours', bot.stats_hours, lambda _id: message_update(_id, '/stats_hours')),
+        ('stats_intervals', bot.stats_intervals, lambda _id: message_update(_id, '/stats_intervals')),
+        ('report', bot.report, lambda _id: message_update(_id, '/report')),
+        ('search', bot.search_messages, lambda _id: message_update(_id, '/search note')),
+        ('topic_callback', bot.topic_callback, lambda _id: callback_update(_id, 'topic add %d' % _id)),
+    ]
+
+    latencies = defaultdict(list)
+    queries = defaultdict(int)
+    for name, handler, make_update in cases:
+        for _ in range(args.calls):
+            update = make_update(random.choice(chats))
+            before = counter.count
+            start = time.perf_counter()
+            await handler(update, None)
+            latencies[name].append(time.perf_counter() - start)
+            queries[name] += counter.count - before
+
+    for _ in range(args.ticks):
+        before = counter.count
+        start = time.perf_counter()
+        await bot.checker(None)
+        latencies['checker'].append(time.perf_counter() - start)
+        queries['checker'] += counter.count - before
+
+    print('%-16s %6s %9s %9s %9s %9s %9s' % ('handler', 'calls', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'queries'))
+    for name, values in latencies.items():
+        print('%-16s %6d %9.2f %9.2f %9.2f %9.2f %9.1f' % (
+            name, len(values),
+            _percentile(values, 0.5) * 1000, _percentile(values, 0.9) * 1000,
+            _percentile(values, 0.99) * 1000, max(values) * 1000,
+            queries[name] / len(values)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=10000)
+    parser.add_argument('--meals', type=int, default=100, help='meals per chat')
+    parser.add_argument('--calls', type=int, default=200, help='calls per handler')
+    parser.add_argument('--ticks', type=int, default=5, help='checker runs')
+    parser.add_argument('--db', help='existing database to use instead of seeding a new one')
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(), 'chats.db')
+    os.environ['NANNYBOT_DB_URL'] = 'sqlite:///' + path
+    os.environ.setdefault('TELEGRAM_TOKEN', '0:bench')
+    base.DB_URL = os.environ['NANNYBOT_DB_URL']
+
+    base.start_engine()
+    if args.db is None:
+        start = time.perf_counter()
+        seed(args.chats, args.meals)
+        print('seeded %d chats, %d meals in %.1fs' % (args.chats, args.chats * args.meals, time.perf_counter() - start),
+              file=sys.stderr)
+
+    import sender
+    sender.GLOBAL_RATE = sender.CHAT_RATE = sender.CHAT_BURST = 10 ** 9
+
+    start = time.perf_counter()
+    import bot
+    print('imported bot in %.1fs' % (time.perf_counter() - start,), file=sys.stderr)
+
+    bot.build_application()
+    stub = StubBot()
+    bot.sender = sender.Sender(stub, sender.GLOBAL_RATE)
+    bot.forwarder = bot.Forwarder(bot.sender)
+    counter = QueryCounter(base.Engine)
+    asyncio.run(run(bot, args, counter))
+
+
+if __name__ == '__main__':
+    main()
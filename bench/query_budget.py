@@ -0,0 +1,118 @@
+"""Fails when a handler or checker runs more SQL statements than its budget.
+
+    python -m bench.query_budget [--chats 500] [--meals 20] [--calls 20]
+
+Seeds a temporary database like bench.handlers, calls every handler
+--calls times for random chats and checker a few times, and counts the
+statements of each call. Budgets do not depend on the number of chats,
+so a lazy load per chat or per row (an N+1) shows up as a failure. Exits
+with status 1 if any call went over.
+"""
+import os
+import sys
+import random
+import asyncio
+import argparse
+import tempfile
+
+import base
+from bench.handlers import seed, StubBot, QueryCounter, message_update, callback_update
+
+# statements per call, the first call for a chat loads its cached state
+BUDGETS = {
+    'start': 4,
+    'callback': 4,
+    'stats': 2,
+    'stats_month': 2,
+    'stats_week': 2,
+    'stats_hours': 2,
+    'stats_intervals': 2,
+    'report': 2,
+    'night': 3,
+    'reset': 3,
+    'topic': 2,
+    'close_topic': 2,
+    'forward_topic': 2,
+    'topic_callback': 3,
+    'search': 1,
+    'notify': 3,
+    'del_notify': 2,
+    'notify_callback': 2,
+    # IN (...) lists are chunked, so this holds up to base.IN_CHUNK due chats
+    'checker': 8,
+}
+
+
+async def run(bot, args, counter):
+    await bot.warm_up()
+    chats = list(range(1, args.chats + 1))
+    cases = [
+        ('start', bot.start, lambda _id: message_update(_id, '/start 3:0:0')),
+        ('callback', bot.callback, lambda _id: message_update(_id, str(random.randint(50, 200)))),
+        ('stats', bot.stats, lambda _id: message_update(_id, '/stats')),
+        ('stats_month', bot.stats_month, lambda _id: message_update(_id, '/stats_month')),
+        ('stats_week', bot.stats_week, lambda _id: message_update(_id, '/stats_week')),
+        ('stats_hours', bot.stats_hours, lambda _id: message_update(_id, '/stats_hours')),
+        ('stats_intervals', bot.stats_intervals, lambda _id: message_update(_id, '/stats_intervals')),
+        ('report', bot.report, lambda _id: message_update(_id, '/report')),
+        ('night', bot.night, lambda _id: message_update(_id, '/night')),
+        ('reset', bot.reset, lambda _id: message_update(_id, '/reset')),
+        ('topic', bot.topic, lambda _id: message_update(_id, '/topic')),
+        ('close_topic', bot.close_topic, lambda _id: message_update(_id, '/close')),
+        ('forward_topic', bot.forward_topic, lambda _id: message_update(_id, '/view')),
+        ('search', bot.search_messages, lambda _id: message_update(_id, '/search note')),
+        ('topic_callback', bot.topic_callback, lambda _id: callback_update(_id, 'topic add %d' % _id)),
+        ('notify', bot.notify, lambda _id: message_update(_id, '/notify 1h vitamins')),
+        ('del_notify', bot.del_notify, lambda _id: message_update(_id, '/del_notify')),
+        ('notify_callback', bot.notify_callback, lambda _id: callback_update(_id, 'notify page 0')),
+    ]
+
+    worst = {}
+    for name, handler, make_update in cases:
+        for _ in range(args.calls):
+            before = counter.count
+            await handler(make_update(random.choice(chats)), None)
+            worst[name] = max(worst.get(name, 0), counter.count - before)
+
+    for _ in range(args.ticks):
+        before = counter.count
+        await bot.checker(None)
+        worst['checker'] = max(worst.get('checker', 0), counter.count - before)
+
+    failed = False
+    print('%-16s %8s %8s' % ('handler', 'worst', 'budget'))
+    for name, count in worst.items():
+        over = count > BUDGETS[name]
+        failed = failed or over
+        print('%-16s %8d %8d%s' % (name, count, BUDGETS[name], '  OVER' if over else ''))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=500)
+    parser.add_argument('--meals', type=int, default=20, help='meals per chat')
+    parser.add_argument('--calls', type=int, default=20, help='calls per handler')
+    parser.add_argument('--ticks', type=int, default=3, help='checker runs')
+    args = parser.parse_args()
+
+    os.environ['NANNYBOT_DB_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'chats.db')
+    os.environ.setdefault('TELEGRAM_TOKEN', '0:bench')
+    base.DB_URL = os.environ['NANNYBOT_DB_URL']
+    base.start_engine()
+    seed(args.chats, args.meals)
+
+    import sender
+    sender.CHAT_RATE = sender.CHAT_BURST = 10 ** 9
+    import bot
+    bot.build_application()
+    stub = StubBot()
+    bot.sender = sender.Sender(stub, 10 ** 9)
+    bot.forwarder = bot.Forwarder(bot.sender)
+    counter = QueryCounter(base.Engine)
+    if asyncio.run(run(bot, args, counter)):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
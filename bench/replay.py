@@ -0,0 +1,216 @@
+"""Feeds Telegram updates to the bot's webhook and measures throughput.
+
+    python -m bench.replay --updates recorded.jsonl
+    python -m bench.replay --synthetic 2000 --chats 50 [--workers 4]
+    python -m bench.replay --updates recorded.jsonl --url http://127.0.0.1:8443/telegram
+
+--updates takes one Update JSON object per line, --synthetic registers
+--chats chats with /start and then logs random feedings in them. Without
+--url the bot is started here in webhook mode on a temporary database,
+talking to a stub Bot API server instead of Telegram, or as --workers
+sharded workers behind dispatcher.py.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import urllib.parse
+
+import httpx
+
+from webhook import _read_request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = '0:replay'
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class StubBotApi:
+    """Answers Bot API requests the way Telegram would, counting them."""
+
+    def __init__(self):
+        self.calls = {}
+        self.first_call = {}
+        self.first_message = {}
+        self.last_call = time.monotonic()
+        self._message_id = 0
+
+    def _result(self, method, params):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'stub', 'username': 'stub_bot'}
+        if method in ('sendMessage', 'forwardMessage'):
+            self._message_id += 1
+            return {'message_id': self._message_id, 'date': int(time.time()),
+                    'chat': {'id': int(params['chat_id']), 'type': 'private'},
+                    'text': params.get('text', '')}
+        return True
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                _, path, headers, body = request
+                method = path.rsplit('/', 1)[-1]
+                params = {key: values[0] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+                self.calls[method] = self.calls.get(method, 0) + 1
+                self.last_call = time.monotonic()
+                self.first_call.setdefault(method, self.last_call)
+                if method == 'sendMessage':
+                    self.first_message.setdefault(int(params['chat_id']), self.last_call)
+                response = json.dumps({'ok': True, 'result': self._result(method, params)}).encode()
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                             b'Content-Length: %d\r\n\r\n' % len(response) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, port):
+        return await asyncio.start_server(self._handle, '127.0.0.1', port)
+
+
+def synthetic(count, chats):
+    now = int(time.time())
+
+    def update(update_id, chat_id, text):
+        message = {'message_id': update_id, 'date': now, 'text': text,
+                   'chat': {'id': chat_id, 'type': 'private'},
+                   'from': {'id': chat_id, 'is_bot': False, 'first_name': 'replay'}}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split(' ')[0])}]
+        return {'update_id': update_id, 'message': message}
+
+    for chat_id in range(1, chats + 1):
+        yield update(chat_id, chat_id, '/start 3:0:0')
+    for i in range(count):
+        yield update(chats + i + 1, random.randint(1, chats), str(random.randint(50, 200)))
+
+
+def recorded(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _chat_id(update):
+    for kind in ('message', 'edited_message', 'callback_query'):
+        if kind in update:
+            message = update[kind].get('message', update[kind])
+            return message.get('chat', {}).get('id', 0)
+    return 0
+
+
+async def post_all(url, updates, concurrency, secret):
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+    # one connection per chat keeps each chat's updates in order, like Telegram does
+    queues = [asyncio.Queue(2) for _ in range(concurrency)]
+    posted = 0
+
+    async def worker(client, queue):
+        nonlocal posted
+        while True:
+            update = await queue.get()
+            if update is None:
+                return
+            response = await client.post(url, json=update, headers=headers)
+            response.raise_for_status()
+            posted += 1
+
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=concurrency)) as client:
+        workers = [asyncio.ensure_future(worker(client, queue)) for queue in queues]
+        for update in updates:
+            await queues[_chat_id(update) % concurrency].put(update)
+        for queue in queues:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    return posted
+
+
+async def _wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.returncode is not None:
+            raise RuntimeError('bot exited with %d' % (process.returncode,))
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError('bot did not start listening on %d' % (port,))
+
+
+async def main(args):
+    updates = recorded(args.updates) if args.updates else synthetic(args.synthetic, args.chats)
+
+    if args.url:
+        start = time.perf_counter()
+        posted = await post_all(args.url, updates, args.concurrency, args.secret)
+        elapsed = time.perf_counter() - start
+        print('posted %d updates in %.2fs, %.0f updates/s' % (posted, elapsed, posted / elapsed))
+        return
+
+    stub = StubBotApi()
+    api_port, webhook_port = _free_port(), _free_port()
+    await stub.start(api_port)
+    env = dict(os.environ,
+               TELEGRAM_TOKEN=TOKEN,
+               NANNYBOT_MODE='webhook',
+               NANNYBOT_BOT_API_URL='http://127.0.0.1:%d/bot' % (api_port,),
+               NANNYBOT_WEBHOOK_PORT=str(webhook_port),
+               # Telegram's flood limits do not apply to the stub
+               NANNYBOT_SEND_RATE='1000000',
+               NANNYBOT_SEND_CHAT_RATE='1000000',
+               NANNYBOT_DB_URL='sqlite:///' + os.path.join(tempfile.mkdtemp(), 'chats.db'))
+    env.pop('NANNYBOT_WEBHOOK_URL', None)
+    env.pop('NANNYBOT_WEBHOOK_SECRET', None)
+    script = 'bot.py'
+    if args.workers:
+        script = 'dispatcher.py'
+        env.update(NANNYBOT_WORKERS=str(args.workers), NANNYBOT_WORKER_PORT=str(_free_port()))
+    process = await asyncio.create_subprocess_exec(sys.executable, os.path.join(ROOT, script), cwd=ROOT, env=env)
+    try:
+        await _wait_for_port(webhook_port, process)
+        url = 'http://127.0.0.1:%d/telegram' % (webhook_port,)
+        start = time.monotonic()
+        posted = await post_all(url, updates, args.concurrency, None)
+        accepted = time.monotonic() - start
+        # replies are done once the stub has been idle for a while
+        while time.monotonic() - stub.last_call < args.idle:
+            await asyncio.sleep(0.1)
+        handled = stub.last_call - start
+        replies = stub.calls.get('sendMessage', 0)
+        print('posted %d updates in %.2fs (%.0f/s), %d replies after %.2fs (%.0f updates/s)' % (
+            posted, accepted, posted / accepted, replies, handled, posted / handled))
+        print('bot api calls: %s' % (stub.calls,))
+    finally:
+        process.terminate()
+        await process.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--updates', help='file with one Update JSON object per line')
+    source.add_argument('--synthetic', type=int, help='number of synthetic feedings')
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--url', help='webhook of a running bot')
+    parser.add_argument('--secret', help='secret token of a running bot')
+    parser.add_argument('--workers', type=int, default=0, help='run this many workers behind dispatcher.py')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--idle', type=float, default=2., help='seconds without Bot API calls that end the run')
+    asyncio.run(main(parser.parse_args()))
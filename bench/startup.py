@@ -0,0 +1,106 @@
+"""Time from starting the bot until it answers its first update.
+
+    python -m bench.startup [--chats 10000] [--meals 100] [--runs 5] [--migrate]
+
+Seeds a temporary database like bench.handlers, then starts bot.py in
+webhook mode against a stub Bot API --runs times. Each run posts /start
+for a new chat as soon as the webhook port accepts connections and
+reports when the port opened and when the reply reached the stub. Every
+seeded chat is overdue, so the bot also starts with a full checker run.
+--migrate clears the schema version first, so every run goes through
+create_all and migrate() like the first start on an old chats.db.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+import httpx
+
+import base
+from bench.handlers import seed
+from bench.replay import StubBotApi, ROOT, TOKEN, _free_port
+
+
+async def _listening(port, process):
+    while True:
+        if process.returncode is not None:
+            raise RuntimeError('bot exited with %d' % (process.returncode,))
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.005)
+
+
+async def run_once(db_url, chat_id):
+    stub = StubBotApi()
+    api_port, webhook_port = _free_port(), _free_port()
+    server = await stub.start(api_port)
+    env = dict(os.environ,
+               TELEGRAM_TOKEN=TOKEN,
+               NANNYBOT_MODE='webhook',
+               NANNYBOT_BOT_API_URL='http://127.0.0.1:%d/bot' % (api_port,),
+               NANNYBOT_WEBHOOK_PORT=str(webhook_port),
+               NANNYBOT_LOG_LEVEL='WARNING',
+               NANNYBOT_SEND_RATE='1000000',
+               NANNYBOT_SEND_CHAT_RATE='1000000',
+               NANNYBOT_DB_URL=db_url)
+    env.pop('NANNYBOT_WEBHOOK_URL', None)
+    env.pop('NANNYBOT_WEBHOOK_SECRET', None)
+    update = {'update_id': 1, 'message': {
+        'message_id': 1, 'date': int(time.time()), 'text': '/start 3:0:0',
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'startup'},
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len('/start')}]}}
+
+    start = time.monotonic()
+    process = await asyncio.create_subprocess_exec(sys.executable, os.path.join(ROOT, 'bot.py'), cwd=ROOT, env=env)
+    try:
+        await _listening(webhook_port, process)
+        listening = time.monotonic() - start
+        async with httpx.AsyncClient() as client:
+            response = await client.post('http://127.0.0.1:%d/telegram' % (webhook_port,), json=update)
+            response.raise_for_status()
+        while chat_id not in stub.first_message:
+            await asyncio.sleep(0.005)
+        return listening, stub.first_message[chat_id] - start
+    finally:
+        process.terminate()
+        await process.wait()
+        server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=10000)
+    parser.add_argument('--meals', type=int, default=100, help='meals per chat')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--migrate', action='store_true', help='run the schema setup on every start')
+    args = parser.parse_args()
+
+    db_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'chats.db')
+    base.start_engine(db_url)
+    seed(args.chats, args.meals)
+    print('seeded %d chats, %d meals' % (args.chats, args.chats * args.meals), file=sys.stderr)
+
+    listening, replied = [], []
+    for _ in range(args.runs):
+        if args.migrate:
+            with base.Engine.begin() as conn:
+                conn.exec_driver_sql('PRAGMA user_version = 0')
+        port, reply = asyncio.run(run_once(db_url, args.chats + 1))
+        listening.append(port)
+        replied.append(reply)
+
+    print('%-22s %9s %9s %9s' % ('', 'min ms', 'median ms', 'max ms'))
+    for name, values in (('webhook listening', listening), ('first reply', replied)):
+        print('%-22s %9.0f %9.0f %9.0f' % (name, min(values) * 1000, statistics.median(values) * 1000, max(values) * 1000))
+
+
+if __name__ == '__main__':
+    main()
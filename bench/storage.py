@@ -0,0 +1,57 @@
+"""Meal insert and query throughput of the default and the tuned engine.
+
+    python -m bench.storage [--chats 100] [--meals 2000] [--queries 2000]
+
+Every insert is its own transaction, like callback does for a feeding.
+"""
+import os
+import time
+import random
+import argparse
+import datetime
+import tempfile
+
+import base
+from base import make_session, Chat, Meal, daily_meal_totals
+
+
+def _run(profile, args):
+    path = os.path.join(tempfile.mkdtemp(), 'chats.db')
+    base.start_engine('sqlite:///' + path, profile)
+    with make_session() as session:
+        for _id in range(args.chats):
+            session.add(Chat(id=_id, period=3 * 60 * 60, state=''))
+
+    now = datetime.datetime.utcnow()
+    start = time.perf_counter()
+    for i in range(args.meals):
+        with make_session() as session:
+            session.add(Meal(chat_id=random.randrange(args.chats), amount=100,
+                             time=now - datetime.timedelta(minutes=i)))
+    inserts = args.meals / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(args.queries):
+        with make_session() as session:
+            daily_meal_totals(session, random.randrange(args.chats), now, 31)
+    queries = args.queries / (time.perf_counter() - start)
+
+    base.Engine.dispose()
+    return inserts, queries
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--meals', type=int, default=2000)
+    parser.add_argument('--queries', type=int, default=2000)
+    args = parser.parse_args()
+
+    print('%-8s %12s %12s' % ('profile', 'inserts/s', 'queries/s'))
+    for profile in ('default', 'tuned'):
+        inserts, queries = _run(profile, args)
+        print('%-8s %12.0f %12.0f' % (profile, inserts, queries))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,68 +1,96 @@
 import os
-import sys
+import time
+import asyncio
 import logging
 import datetime
 from collections import defaultdict
-from base import make_session, Message, Chat, Meal, Topic, start_engine, Notify
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+from base import async_session, chunks, alarm_time, Message, Chat, Meal, Topic, start_engine, Notify, daily_meal_totals
+from scheduler import Scheduler, RETRY_DELAY
+from sender import Sender, GLOBAL_RATE
+from chat_cache import ChatCache, CachedChat
+from writebehind import WriteBuffer
+from forwarding import Forwarder
+from mutes import MuteStore
+from lanes import LaneApplication, MAX_IN_FLIGHT
+from shards import owned, WORKERS
+import metrics
+from metrics import timed
+import aggregates
+import retention
+import search
+from telegram import InlineKeyboardButton
+from keyboards import MenuCache, paginate
 from telegram.ext import Application, MessageHandler, CommandHandler, CallbackQueryHandler
-from validators import validate_period, validate_time_and_meal, validate_meal, format_period, format_time, validate_time, validate_delta
-import sqlalchemy
+from validators import validate_period, format_period, format_time, validate_delta, parse_message, MealEntry
 
 
-app = Application.builder().token(os.environ['TELEGRAM_TOKEN']).build()
+# 'polling' or 'webhook'
+MODE = os.environ.get('NANNYBOT_MODE', 'polling')
+# a local Bot API server, or a stub one for load tests
+BOT_API_URL = os.environ.get('NANNYBOT_BOT_API_URL', 'https://api.telegram.org/bot')
 
+# chats fed within this many hours are loaded into the cache at startup
+WARM_UP_HOURS = int(os.environ.get('NANNYBOT_WARM_UP_HOURS', 24))
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-start_engine()
-
-log = logging.getLogger(__name__)
+# days of meals /stats_hours and /stats_intervals look at, and weeks of /stats_week
+ANALYTICS_DAYS = 30
+ANALYTICS_WEEKS = 12
 
+# set by build_application()
+app = None
+scheduler = None
+sender = None
+forwarder = None
 
-async def stop(update, context):
-    _id = update.message.chat.id
-    with make_session() as session:
-        session.query(Chat).filter(Chat.id == _id).delete(synchronize_session='fetch')
+log = logging.getLogger(__name__)
 
 
-app.add_handler(CommandHandler('stop', stop))
+@async_session
+def _delete_chat(session, _id):
+    session.query(Chat).filter(Chat.id == _id).delete(synchronize_session='fetch')
 
 
+@timed
+async def stop(update, context):
+    _id = update.message.chat.id
+    # queued rows of the chat are written before the chat is gone, not after
+    await writes.flush()
+    await _delete_chat(_id)
+    scheduler.cancel(('chat', _id))
+    aggregates.drop(_id)
+    chat_cache.drop(_id)
+    menus.drop(_id)
+
+
+async def meal_aggregate(_id):
+    # loaded on first use rather than for every chat at startup
+    if not aggregates.loaded(_id):
+        await writes.flush()
+        await aggregates.reload(_id)
+        if not aggregates.loaded(_id):
+            raise ChatNotFound(_id)
+    return aggregates.get(_id)
+
+
+@timed
 async def report(update, context):
     _id = update.message.chat.id
-    now = datetime.datetime.utcnow()
     result = ''
-    with make_session() as session:
-        chat = session.query(Chat).filter(Chat.id == _id).one()
-        for meal in chat.meals:
-            if meal.time + datetime.timedelta(days=1) > now:
-                result += '%d %s\n' % (meal.amount, str(meal.time))
-    await update.message.reply_text(result)
-
-
-app.add_handler(CommandHandler('report', report))
+    for time, amount in (await meal_aggregate(_id)).day.meals:
+        result += '%d %s\n' % (amount, str(time))
+    await sender.reply(update.message, result)
 
 
+@timed
 async def stats(update, context):
     _id = update.message.chat.id
     now = datetime.datetime.utcnow()
-    maxtime = None
-    sm = 0
-    cnt = 0
-
-    period_sm = 0
-    with make_session() as session:
-        chat = session.query(Chat).filter(Chat.id == _id).one()
-        for meal in chat.meals:
-            if meal.time + chat.period_time() > now:
-                period_sm += meal.amount
-            if meal.time + datetime.timedelta(days=1) > now:
-                sm += meal.amount
-                cnt += 1
-            if maxtime is None or meal.time > maxtime:
-                maxtime = meal.time
-
-    delta = now - maxtime
+    aggregate = await meal_aggregate(_id)
+    sm = aggregate.day.sum
+    cnt = aggregate.day.count
+    period_sm = aggregate.period_sum()
+
+    delta = now - aggregate.last_meal
 
     hour = datetime.timedelta(hours=1)
     hours = int(delta / hour)
@@ -70,47 +98,100 @@ async def stats(update, context):
     minute = datetime.timedelta(minutes=1)
     minutes = int((delta - hour * hours) / minute)
 
-    await update.message.reply_text('За день кушали %d раз, суммарно выпили %dмл. За установленный период съели %dмл. Последний раз кушали %d часов %d минут назад' % (cnt, sm, period_sm, hours, minutes))
-
-
-app.add_handler(CommandHandler('stats', stats))
+    await sender.reply(update.message, 'За день кушали %d раз, суммарно выпили %dмл. За установленный период съели %dмл. Последний раз кушали %d часов %d минут назад' % (cnt, sm, period_sm, hours, minutes))
 
 
+@timed
 async def night(update, context):
     now = datetime.datetime.utcnow()
-    _muted_chats[update.message.chat.id] = now + datetime.timedelta(hours=12)
-
-    await update.message.reply_text('Режим тишины включен на 12 часов')
+    await mutes.mute({update.message.chat.id: now + datetime.timedelta(hours=12)}, now)
 
-
-app.add_handler(CommandHandler('night', night))
+    await sender.reply(update.message, 'Режим тишины включен на 12 часов')
 
 
+@timed
 async def stats_month(update, context):
     _id = update.message.chat.id
     now = datetime.datetime.utcnow()
-    maxtime = None
-    sm = 0
-    cnt = 0
-
-    period_sm = 0
-    with make_session() as session:
-        chat = session.query(Chat).filter(Chat.id == _id).one()
-        result = [0]*31
-        for meal in chat.meals:
-            day = int((now - meal.time) / datetime.timedelta(days=1))
-            if day < 31:
-                result[day] += meal.amount
-                
+    await writes.flush()
+    result = await async_session(daily_meal_totals)(_id, now, 31)
+
     resstr = ""
     for res in result[::-1]:
         resstr += str(res) + "\n"
-    await update.message.reply_text(resstr)
+    await sender.reply(update.message, resstr)
+
+
+# analytics is imported in the handlers, numpy is only loaded on first use
+@timed
+async def stats_week(update, context):
+    import analytics
+    _id = update.message.chat.id
+    now = datetime.datetime.utcnow()
+    await writes.flush()
+    feedings = await analytics.load(_id, now - datetime.timedelta(weeks=ANALYTICS_WEEKS))
+
+    resstr = ""
+    for total in analytics.weekly(feedings, now, ANALYTICS_WEEKS)[::-1]:
+        resstr += '%d мл, %d мл в день\n' % (total, total / 7)
+    await sender.reply(update.message, resstr)
+
+
+@timed
+async def stats_hours(update, context):
+    import analytics
+    _id = update.message.chat.id
+    now = datetime.datetime.utcnow()
+    await writes.flush()
+    feedings = await analytics.load(_id, now - datetime.timedelta(days=ANALYTICS_DAYS))
+
+    counts, amounts = analytics.hourly(feedings)
+    if not counts.any():
+        await sender.reply(update.message, 'Пока нет кормлений')
+        return
+    resstr = 'По часам (UTC) за %d дней:\n' % (ANALYTICS_DAYS,)
+    for hour in counts.nonzero()[0]:
+        resstr += '%02d:00 — %d раз, в среднем %d мл\n' % (hour, counts[hour], amounts[hour] / counts[hour])
+    await sender.reply(update.message, resstr)
+
 
+def _format_gap(seconds):
+    return format_period(int(seconds) // 60 * 60) or 'меньше минуты'
 
-app.add_handler(CommandHandler('stats_month', stats_month))
+
+@timed
+async def stats_intervals(update, context):
+    import analytics
+    _id = update.message.chat.id
+    now = datetime.datetime.utcnow()
+    await writes.flush()
+    feedings = await analytics.load(_id, now - datetime.timedelta(days=ANALYTICS_DAYS))
+
+    gaps = analytics.intervals(feedings, [10, 50, 90])
+    if gaps is None:
+        await sender.reply(update.message, 'Пока слишком мало кормлений')
+        return
+    short, median, long = gaps
+    # 7 day averages in time order, the last one ends now
+    averages = analytics.rolling_average(analytics.daily(feedings, now, ANALYTICS_DAYS)[::-1], 7)
+    await sender.reply(update.message, 'За %d дней между кормлениями обычно %s, каждый десятый перерыв короче %s и каждый десятый длиннее %s. '
+                                       'За последнюю неделю выпили в среднем %dмл в день, за неделю до того %dмл' %
+                       (ANALYTICS_DAYS, _format_gap(median), _format_gap(short), _format_gap(long), averages[-1], averages[-8]))
+
+
+@async_session
+def _set_period(session, _id, period):
+    existing_users = session.query(Chat).filter(Chat.id == _id).all()
+    if len(existing_users) > 0:
+        existing_users[0].period = period
+        existing_users[0].update_alarm()
+        return existing_users[0].next_alarm
+    else:
+        session.add(Chat(id=_id, period=period, state=ChatState().store()))
+        return None
 
 
+@timed
 async def start(update, context):
     args = update.message.text.split(' ')[1:]
     if len(args) == 0:
@@ -118,41 +199,34 @@ async def start(update, context):
     elif len(args) == 1 :
         period = validate_period(args[0])
 
-    with make_session() as session:
-        _id = update.message.chat.id
-        existing_users = session.query(Chat).filter(Chat.id == _id).all()
-        if len(existing_users) > 0:
-            existing_users[0].period = period
-        else:
-            session.add(Chat(id=_id, period=period, state=ChatState().store()))
+    _id = update.message.chat.id
+    await writes.flush()
+    _alarm = await _set_period(_id, period)
+    chat_cache.drop(_id)
+    await aggregates.reload(_id)
+    scheduler.schedule(('chat', _id), _alarm)
 
     if period is not None:
-        await update.message.reply_text('записала период кормления в %s' % (format_period(period),))
+        await sender.reply(update.message, 'записала период кормления в %s' % (format_period(period),))
     else:
-        await update.message.reply_text('отключила кормления в этом чате')
-
-
-app.add_handler(CommandHandler('start', start))
+        await sender.reply(update.message, 'отключила кормления в этом чате')
 
 
 class ChatState:
     INITIAL = 0
     TOPIC_ADD = 1
 
+    # stored as one number, the topic id above the state bit
     def __init__(self, s=''):
-        if s == '': # initial state
-            self.state = ChatState.INITIAL
-            self.topic = None
-        else:
-            args = s.split(' ', 1)
-            self.state = int(args[0])
-            self.topic = args[1] if len(args) > 1 else None
+        value = int(s) if s else ChatState.INITIAL
+        self.state = value & 1
+        self.topic = (value >> 1) or None
 
     def store(self):
-        return str(self)
+        return str((self.topic or 0) << 1 | self.state)
 
     def __str__(self):
-        return str(self.state) + ('' if self.topic is None else ' ' + self.topic)
+        return str(self.state) + ('' if self.topic is None else ' %d' % (self.topic,))
 
     def adding_meals(self):
         return self.state == ChatState.INITIAL
@@ -175,7 +249,7 @@ class ChatState:
 
 
 def _topic_callback_data(action, content=''):
-    return 'topic ' + action + ' ' + content
+    return 'topic ' + action + ' ' + str(content)
 
 
 def _parse_topic_callback_data(text):
@@ -183,32 +257,39 @@ def _parse_topic_callback_data(text):
     return text.split(' ', 1)
 
 
-async def topic_callback(update, context):
-    with make_session() as session:
-        message = update.callback_query.message
-        chat = query_chat(session, message.chat.id)
-        action, content = _parse_topic_callback_data(update.callback_query.data)
-        if action == 'new':
-            chat.state = ChatState().set_adding_topic().store()
-            await message.reply_text('что хотите записать?')
-        elif action == 'close':
-            for topic in chat.topics:
-                if topic.id == content:
-                    chat.topics.remove(topic)
-                    await app.bot.send_message(chat.id, 'закрыла')
-        elif action == 'add':
-            chat.state = ChatState().set_adding_topic(content).store()
-            await message.reply_text('записываю')
-        elif action == 'forward':
-            messages = session.query(Message).filter(Message.topic_id == content).filter(Message.chat_id == message.chat.id).all()
-            cur_id = chat.id
-            for message in messages:
-                await app.bot.forward_message(chat.id, message.chat.id, message.telegram_id)
-        else:
-            chat.state = ChatState().store()
+@async_session
+def _close_topic(session, _id, topic_id):
+    closed = session.query(Topic).filter(Topic.id == topic_id).filter(Topic.chat_id == _id) \
+        .update({'chat_id': None}, synchronize_session=False)
+    return closed > 0
+
 
+@timed
+async def topic_callback(update, context):
+    message = update.callback_query.message
+    _id = message.chat.id
+    chat = await cached_chat(_id)
+    action, content = _parse_topic_callback_data(update.callback_query.data)
+    if action == 'page':
+        menu, page = content.split(' ')
+        await sender.edit_markup(message, await topic_menu(_id, menu, int(page)))
+    elif action == 'new':
+        await set_state(chat, ChatState().set_adding_topic())
+        await sender.reply(message, 'что хотите записать?')
+    elif action == 'close':
+        if await _close_topic(_id, int(content)):
+            menus.drop(_id)
+            await sender.reply(message, 'закрыла')
+    elif action == 'add':
+        await set_state(chat, ChatState().set_adding_topic(int(content)))
+        await sender.reply(message, 'записываю')
+    elif action == 'forward':
+        await writes.flush()
+        if not forwarder.start(_id, int(content)):
+            await sender.reply(message, 'уже пересылаю')
+    else:
+        await set_state(chat, ChatState())
 
-app.add_handler(CallbackQueryHandler(topic_callback, '^topic.*'))
 
 def check_markup_label(name):
     if name is None:
@@ -217,115 +298,166 @@ def check_markup_label(name):
         return False
     return True
 
-async def topic(update, context):
-    with make_session() as session:
-        chat = query_chat(session, update.message.chat.id)
+@async_session
+def _topics(session, _id):
+    query_chat(session, _id)
+    return [(name, topic_id) for name, topic_id in session.query(Topic.name, Topic.id).filter(Topic.chat_id == _id)
+            if check_markup_label(name)]
 
-        specials = [[InlineKeyboardButton('новая тема', callback_data=_topic_callback_data('new'))]]
 
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(topic.name,
-                                                               callback_data=_topic_callback_data('add', topic.id))]
-                                          for topic in chat.topics if check_markup_label(topic.name)] + specials)
-        await update.message.reply_text('в какую тему хотите написать?', reply_markup=keyboard)
+async def topic_menu(_id, action, page=0):
+    pages = menus.get(_id, 'topic ' + action)
+    if pages is None:
+        specials = []
+        if action == 'add':
+            specials = [[InlineKeyboardButton('новая тема', callback_data=_topic_callback_data('new'))]]
+        buttons = [(name, _topic_callback_data(action, topic_id)) for name, topic_id in await _topics(_id)]
+        pages = paginate(buttons, lambda page: _topic_callback_data('page', '%s %d' % (action, page)), specials)
+        menus.put(_id, 'topic ' + action, pages)
+    return pages[min(page, len(pages) - 1)]
 
 
-app.add_handler(CommandHandler('topic', topic))
+@timed
+async def topic(update, context):
+    keyboard = await topic_menu(update.message.chat.id, 'add')
+    await sender.reply(update.message, 'в какую тему хотите написать?', reply_markup=keyboard)
 
 
-async def close_topic(update, context):
-    with make_session() as session:
-        chat = query_chat(session, update.message.chat.id)
-
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(topic.name,
-                                                       callback_data=_topic_callback_data('close', topic.id))]
-                                  for topic in chat.topics if check_markup_label(topic.name)])
+@timed
+async def search_messages(update, context):
+    words = update.message.text.split()[1:]
+    if not words:
+        await sender.reply(update.message, 'Что найти? Например: /search врач или /search привив*')
+        return
+    await writes.flush()
+    found = await search.search(update.message.chat.id, words)
+    if not found:
+        await sender.reply(update.message, 'Ничего не нашла')
+        return
 
-        await update.message.reply_text('какую тему хотите закрыть?', reply_markup=keyboard)
+    resstr = ""
+    for name, content, time in found:
+        if len(content) > search.PREVIEW:
+            content = content[:search.PREVIEW] + '…'
+        resstr += '%s, %s:\n%s\n\n' % (name, format_time(time), content)
+    await sender.reply(update.message, resstr)
 
 
-app.add_handler(CommandHandler('close', close_topic))
+@timed
+async def close_topic(update, context):
+    keyboard = await topic_menu(update.message.chat.id, 'close')
+    await sender.reply(update.message, 'какую тему хотите закрыть?', reply_markup=keyboard)
 
 
+@timed
 async def forward_topic(update, context):
-    with make_session() as session:
-        chat = query_chat(session, update.message.chat.id)
+    keyboard = await topic_menu(update.message.chat.id, 'forward')
+    await sender.reply(update.message, 'какую тему хотите посмотреть?', reply_markup=keyboard)
+
 
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(topic.name,
-                                                       callback_data=_topic_callback_data('forward', topic.id))]
-                                  for topic in chat.topics if check_markup_label(topic.name)])
+def _notify_callback_data(_id):
+    return 'notify ' + str(_id)
 
-        await update.message.reply_text('какую тему хотите посмотреть?', reply_markup=keyboard)
 
+def _notify_page_callback_data(page):
+    return 'notify page %d' % (page,)
 
-app.add_handler(CommandHandler('forward', forward_topic))
-app.add_handler(CommandHandler('view', forward_topic))
 
-def _notify_callback_data(_id):
-    return 'notify ' + str(_id)
+def _parse_notify_page_callback_data(text):
+    if not text.startswith('notify page '):
+        return None
+    return int(text[len('notify page '):])
 
 
 def _parse_notify_callback_data(text):
     return int(text[len('notify '):])
 
 
+@async_session
+def _delete_notify(session, _notify_id):
+    session.query(Notify).filter(Notify.id == _notify_id).filter().delete(synchronize_session='fetch')
+
+
+@timed
 async def notify_callback(update, context):
+    message = update.callback_query.message
+    page = _parse_notify_page_callback_data(update.callback_query.data)
+    if page is not None:
+        await sender.edit_markup(message, await notify_menu(message.chat.id, page))
+        return
     _notify_id = _parse_notify_callback_data(update.callback_query.data)
-    with make_session() as session:
-        session.query(Notify).filter(Notify.id == _notify_id).filter().delete(synchronize_session='fetch')
-    await app.bot.send_message(update.callback_query.message.chat.id, 'удалила')
+    await _delete_notify(_notify_id)
+    scheduler.cancel(('notify', _notify_id))
+    menus.drop(message.chat.id)
+    await sender.send(message.chat.id, 'удалила')
 
 
-app.add_handler(CallbackQueryHandler(notify_callback, '^notify.*'))
+@async_session
+def _notifies(session, _id):
+    query_chat(session, _id)
+    return [(message, notify_id) for message, notify_id in session.query(Notify.message, Notify.id).filter(Notify.chat_id == _id)
+            if check_markup_label(message)]
 
 
-async def del_notify(update, context):
-    with make_session() as session:
-        chat = query_chat(session, update.message.chat.id)
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(notify.message,
-                                                       callback_data=_notify_callback_data(notify.id))]
-                                  for notify in chat.notifies if check_markup_label(notify.message)])
+async def notify_menu(_id, page=0):
+    pages = menus.get(_id, 'notify')
+    if pages is None:
+        buttons = [(message, _notify_callback_data(notify_id)) for message, notify_id in await _notifies(_id)]
+        pages = paginate(buttons, _notify_page_callback_data)
+        menus.put(_id, 'notify', pages)
+    return pages[min(page, len(pages) - 1)]
 
-        await update.message.reply_text('удалить уведомление', reply_markup=keyboard)
 
+@timed
+async def del_notify(update, context):
+    keyboard = await notify_menu(update.message.chat.id)
+    await sender.reply(update.message, 'удалить уведомление', reply_markup=keyboard)
 
-app.add_handler(CommandHandler('del_notify', del_notify))
 
+@async_session
+def _add_notify(session, _id, message, period, first_time):
+    query_chat(session, _id)
+    _notify = Notify(chat_id=_id, message=message, period=period)
+    _notify.reschedule(first_time)
+    session.add(_notify)
+    session.flush()
+    return ('notify', _notify.id), _notify.next_time
 
-async def notify(update, context):
-    _reply_message = None
-    with make_session() as session:
-        chat = query_chat(session, update.message.chat.id)
-        message = update.message.text.split(' ', 1)[1]
-
-        args = message.split(' ', 1)
-        delta = validate_delta(args[0])
-        if delta is None:
-            delta = datetime.timedelta()
-        else:
-            message = args[1]
 
-        args = message.split(' ', 1)
-        period = validate_period(args[0])
-        if period is None:
-            period = validate_period('24:0:0')
-        else:
-            message = args[1]
+@timed
+async def notify(update, context):
+    message = update.message.text.split(' ', 1)[1]
 
-        if message == "":
-            return
+    args = message.split(' ', 1)
+    delta = validate_delta(args[0])
+    if delta is None:
+        delta = datetime.timedelta()
+    else:
+        message = args[1]
 
-        session.add(Notify(chat_id=update.message.chat.id, message=message, period=period, last_time=datetime.datetime.utcnow() + delta))
-        _reply_message = 'Добавила уведомление с сообщением "%s" раз в %s' % (message, format_period(period))
+    args = message.split(' ', 1)
+    period = validate_period(args[0])
+    if period is None:
+        period = validate_period('24:0:0')
+    else:
+        message = args[1]
 
-    await update.message.reply_text(_reply_message)
+    if message == "":
+        return
 
+    _scheduled = await _add_notify(update.message.chat.id, message, period, datetime.datetime.utcnow() + delta)
+    _reply_message = 'Добавила уведомление с сообщением "%s" раз в %s' % (message, format_period(period))
 
+    scheduler.schedule(*_scheduled)
+    menus.drop(update.message.chat.id)
+    await sender.reply(update.message, _reply_message)
 
-app.add_handler(CommandHandler('notify', notify))
 
 
 class ChatNotFound(Exception):
-    pass
+    def __init__(self, chat_id):
+        super().__init__(chat_id)
+        self.chat_id = chat_id
 
 
 def query_chat(session, _id):
@@ -333,124 +465,293 @@ def query_chat(session, _id):
     if len(chats) > 0:
         return chats[0]
     else:
-        app.bot.send_message(_id, 'незарегистрированный чат #%d' % (_id,))
-        raise ChatNotFound()
+        # runs in the db thread, on_error tells the chat
+        raise ChatNotFound(_id)
+
+
+async def on_error(update, context):
+    if isinstance(context.error, ChatNotFound):
+        await sender.send(context.error.chat_id, 'незарегистрированный чат #%d' % (context.error.chat_id,))
+    else:
+        log.error('update %s failed', update, exc_info=context.error)
+
+
+chat_cache = ChatCache()
+menus = MenuCache()
+writes = WriteBuffer()
+
+
+@async_session
+def _load_chat(session, _id):
+    chat = query_chat(session, _id)
+    return CachedChat(chat.id, chat.period, ChatState(chat.state), chat.last_meal)
+
+
+async def cached_chat(_id):
+    chat = chat_cache.get(_id)
+    if chat is None:
+        await writes.flush()
+        chat = await _load_chat(_id)
+        chat_cache.put(chat)
+    return chat
+
 
+@async_session
+def _store_state(session, _id, state):
+    session.query(Chat).filter(Chat.id == _id).update({'state': state}, synchronize_session=False)
 
+
+async def set_state(chat, state):
+    await _store_state(chat.id, state.store())
+    chat.state = state
+
+
+@timed
 async def reset(update, content):
     _id = update.message.chat.id
-    with make_session() as session:
-        chat = query_chat(session, _id)
-        chat.state = ChatState().store()
-    await update.message.reply_text('готово!')
+    await set_state(await cached_chat(_id), ChatState())
+    await sender.reply(update.message, 'готово!')
+
 
+async def _add_meal(_id, amount, time, last_meal, next_alarm):
+    # one transaction, so next_alarm never lags behind the meals
+    await writes.add(inserts=[(Meal, {'chat_id': _id, 'amount': amount, 'time': time})],
+                     updates=[(Chat, _id, {'last_meal': last_meal, 'next_alarm': next_alarm})])
 
-app.add_handler(CommandHandler('reset', reset))
 
+@async_session
+def _add_topic(session, _id, name):
+    topic = Topic(chat_id=_id, name=name)
+    session.add(topic)
+    session.flush()
+    state = ChatState().set_adding_topic(topic.id)
+    session.query(Chat).filter(Chat.id == _id).update({'state': state.store()}, synchronize_session=False)
+    return state
 
-def new_topic_id():
-    import uuid
-    return str(uuid.uuid4())
 
+async def _add_topic_message(_id, topic_id, telegram_id, content, time):
+    await writes.insert(Message, telegram_id=telegram_id, chat_id=_id, topic_id=topic_id, content=content, time=time)
 
+
+@timed
 async def callback(update, context):
     _id = update.message.chat.id
     _text = update.message.text
-    _date = update.message.date
+    _date = update.message.date.replace(tzinfo=None)
 
     if _text == '.':
         await reset(update, context)
         return
     
-    meal_date = _date
-    meal_amount = validate_meal(_text)
-
-    if meal_amount is None:
-        meal_date, meal_amount = validate_time_and_meal(meal_date, _text)
-
-    _period = validate_period(_text)
-    _time = validate_time(_text)
-
     _notify = None
 
-    with make_session() as session:
-        chat = query_chat(session, _id)
-
-        state = ChatState(chat.state)
-        print('cur state = ', state)
-        if state.adding_meals():
-            if meal_amount is not None:
-                session.add(Meal(chat_id=_id, amount=meal_amount, time=meal_date))
-            _notify = 'записала кормление %d мл %s' % (meal_amount, format_time(meal_date))
-        elif state.adding_topic():
-            print('adding topic')
-            if state.new_topic():
-                print('adding new topic')
-                _topic_id = new_topic_id()
-                
-                session.add(Topic(id=_topic_id, chat_id=_id, name=_text))
-                print(_topic_id)
-                chat.state = state.set_adding_topic(_topic_id).store()
-                print('state', state)
-                _notify = 'записываю'
-            else:
-                print('topic id', str(state.topic), type(state.topic))
-                session.add(Message(telegram_id=update.message.message_id, chat_id=_id, topic_id=state.topic, content=_text, time=_date))
+    chat = await cached_chat(_id)
+    state = chat.state
+    log.debug('cur state = %s', state)
+    if state.adding_meals():
+        entry = parse_message(_text or '')
+        if isinstance(entry, MealEntry):
+            meal_date = _date + entry.delta
+            last_meal = chat.last_meal_with(meal_date)
+            _alarm = alarm_time(last_meal, chat.period)
+            await _add_meal(_id, entry.amount, meal_date, last_meal, _alarm)
+            chat.last_meal = last_meal
+            aggregates.add_meal(_id, meal_date, entry.amount)
+            scheduler.schedule(('chat', _id), _alarm)
+            _notify = 'записала кормление %d мл %s' % (entry.amount, format_time(meal_date))
+    elif state.adding_topic():
+        log.debug('adding topic')
+        if state.new_topic():
+            log.debug('adding new topic')
+            state = await _add_topic(_id, _text)
+            menus.drop(_id)
+            chat.state = state
+            log.debug('new topic %d, state %s', state.topic, state)
+            _notify = 'записываю'
+        else:
+            log.debug('topic id %d', state.topic)
+            await _add_topic_message(_id, state.topic, update.message.message_id, _text, _date)
 
     if _notify is not None:
-        await update.message.reply_text(_notify)
+        await sender.reply(update.message, _notify)
 
-app.add_handler(MessageHandler(None, callback))
 
-_muted_chats = {}
+@async_session
+def _due(session, now):
+    due_notifies = session.query(Notify.id, Notify.chat_id, Notify.message).join(Notify.chat) \
+        .filter(Notify.next_time <= now).filter(owned(Notify.chat_id))
+    due_chats = session.query(Chat.id, Chat.last_meal, Chat.period).filter(Chat.next_alarm <= now).filter(owned(Chat.id))
+    return due_notifies.all(), due_chats.all()
 
-log.debug('starting polling')
+
+@async_session
+def _reschedule_notifies(session, ids, now):
+    rows = []
+    for chunk in chunks(ids):
+        for _id, period in session.query(Notify.id, Notify.period).filter(Notify.id.in_(chunk)):
+            rows.append({'id': _id, 'last_time': now, 'next_time': now + datetime.timedelta(seconds=period)})
+    # one executemany instead of an UPDATE per notify
+    session.bulk_update_mappings(Notify, rows)
+    return [(('notify', row['id']), row['next_time']) for row in rows]
 
 
 async def checker(_):
-    print('checking chats', file=sys.stderr)
+    log.debug('checking chats')
+    start = time.perf_counter()
     notifies = defaultdict(lambda: [])
     now = datetime.datetime.utcnow()
-    _notified = set()
-
-    with make_session() as session:
-        chats = session.query(Chat)
-        for chat in chats:
-            for notify in chat.notifies:
-                if now > notify.last_time + notify.period_time():
-                    notifies[chat.id].append(notify.message)
-                    _notified.add(notify.id)
-
-            if chat.period is not None:
-                try:
-                    print(chat, file=sys.stderr)
-                    maxtime = None
-                    for meal in chat.meals:
-                        if maxtime is None or meal.time > maxtime:
-                            maxtime = meal.time
-
-                    if maxtime is not None and maxtime + chat.period_time() < now:
-                        if chat.id in _muted_chats and _muted_chats[chat.id] > now:
-                            continue
-                        delta = now - meal.time
-                        ratio = int(delta / datetime.timedelta(seconds=chat.period))
-                        notifies[chat.id].append('Пора кормить ребенка! Прошло больше %d периодов кормления!' % (ratio,))
-                        _muted_chats[chat.id] = now + datetime.timedelta(minutes=10)
-                except Exception as e:
-                    print(e, file=sys.stderr)
-
-    for key, value in notifies.items():
-        for msg in value:
-            if msg != "":
-                print(key, msg, file=sys.stderr)
-                await app.bot.send_message(key, msg)
-
+    _notified = defaultdict(lambda: [])
+
+    await writes.flush()
+    due_notifies, due_chats = await _due(now)
+    for _notify_id, chat_id, message in due_notifies:
+        notifies[chat_id].append(message)
+        _notified[chat_id].append(_notify_id)
+
+    muted = mutes.muted([chat_id for chat_id, _, _ in due_chats], now)
+    alarmed = {}
+    for chat_id, last_meal, period in due_chats:
+        try:
+            log.debug('chat %s is due', chat_id)
+            if chat_id in muted:
+                scheduler.schedule(('chat', chat_id), muted[chat_id])
+                continue
+            delta = now - last_meal
+            ratio = int(delta / datetime.timedelta(seconds=period))
+            notifies[chat_id].append('Пора кормить ребенка! Прошло больше %d периодов кормления!' % (ratio,))
+            alarmed[chat_id] = now + datetime.timedelta(minutes=10)
+            scheduler.schedule(('chat', chat_id), alarmed[chat_id])
+        except Exception:
+            log.exception('alarm for chat %s failed', chat_id)
+    await mutes.mute(alarmed, now)
+    metrics.due_alarms.set(len(due_notifies) + len(alarmed))
+
+    failed = await sender.send_digest(notifies)
+    if failed:
+        # notifies of these chats stay due and are picked up by the retry
+        scheduler.schedule(('retry',), now + RETRY_DELAY)
+
+    _notified = [_notify_id for chat_id, ids in _notified.items() if chat_id not in failed for _notify_id in ids]
     if _notified:
-        print('notified ids', _notified, file=sys.stderr)
-        with make_session() as session:
-            notify = session.execute(sqlalchemy.update(Notify).filter(Notify.id.in_(_notified)).values({'last_time': now}))
+        log.debug('notified ids %s', _notified)
+        for key, due in await _reschedule_notifies(_notified, now):
+            scheduler.schedule(key, due)
+    metrics.checker_seconds.observe(time.perf_counter() - start)
+
+
+mutes = MuteStore()
+
 
+@async_session
+def _schedule(session):
+    notifies = session.query(Notify.id, Notify.next_time).join(Notify.chat) \
+        .filter(Notify.next_time != None).filter(owned(Notify.chat_id))
+    chats = session.query(Chat.id, Chat.next_alarm).filter(Chat.next_alarm != None).filter(owned(Chat.id))
+    return [(('notify', _id), due) for _id, due in notifies] + [(('chat', _id), due) for _id, due in chats]
+
+
+@async_session
+def _hot_chats(session, since, limit):
+    chats = session.query(Chat.id, Chat.period, Chat.state, Chat.last_meal) \
+        .filter(Chat.last_meal > since).filter(owned(Chat.id)) \
+        .order_by(Chat.last_meal.desc()).limit(limit)
+    return [CachedChat(_id, period, ChatState(state), last_meal) for _id, period, state, last_meal in chats]
+
+
+async def warm_up():
+    """Loads mutes, the schedule and recently active chats.
+
+    Runs in the background while updates are already being handled, a
+    chat that is needed before it is loaded is read on demand. Mutes go
+    first, so the first checker run already sees them.
+    """
+    start = time.perf_counter()
+    await async_session(mutes.load)()
+    scheduler.load(await _schedule())
+    await forwarder.resume()
+    since = datetime.datetime.utcnow() - datetime.timedelta(hours=WARM_UP_HOURS)
+    chat_cache.start_warm_up()
+    chats = await _hot_chats(since, chat_cache.size)
+    chat_cache.warm(chats)
+    log.info('warmed up %d chats in %.2fs', len(chats), time.perf_counter() - start)
+
+
+# the running warm_up(), the event loop only keeps a weak reference to tasks
+warm_up_task = None
+
+
+def start_warm_up():
+    global warm_up_task
+    warm_up_task = asyncio.ensure_future(warm_up())
+    warm_up_task.add_done_callback(_warmed_up)
+
+
+def _warmed_up(task):
+    if task.cancelled() or task.exception() is None:
+        return
+    # without mutes and the schedule alarms go to muted chats or not at all, every step is safe to repeat
+    log.error('warm up failed, retrying in %s', RETRY_DELAY, exc_info=task.exception())
+    asyncio.get_running_loop().call_later(RETRY_DELAY.total_seconds(), start_warm_up)
+
+
+async def on_startup(_):
+    await metrics.serve()
+    start_warm_up()
+    app.job_queue.run_repeating(retention.maintain, retention.MAINTENANCE_INTERVAL, first=retention.MAINTENANCE_INTERVAL / 12)
+
+
+async def flush_writes(_):
+    await writes.flush()
+
+
+def build_application():
+    global app, scheduler, sender, forwarder
+    app = Application.builder().token(os.environ['TELEGRAM_TOKEN']).base_url(BOT_API_URL) \
+        .application_class(LaneApplication) \
+        .update_queue(asyncio.Queue(MAX_IN_FLIGHT)).build()
+
+    app.add_handler(CommandHandler('stop', stop))
+    app.add_handler(CommandHandler('report', report))
+    app.add_handler(CommandHandler('stats', stats))
+    app.add_handler(CommandHandler('night', night))
+    app.add_handler(CommandHandler('stats_month', stats_month))
+    app.add_handler(CommandHandler('stats_week', stats_week))
+    app.add_handler(CommandHandler('stats_hours', stats_hours))
+    app.add_handler(CommandHandler('stats_intervals', stats_intervals))
+    app.add_handler(CommandHandler('start', start))
+    app.add_handler(CallbackQueryHandler(topic_callback, '^topic.*'))
+    app.add_handler(CommandHandler('topic', topic))
+    app.add_handler(CommandHandler('close', close_topic))
+    app.add_handler(CommandHandler('forward', forward_topic))
+    app.add_handler(CommandHandler('view', forward_topic))
+    app.add_handler(CommandHandler('search', search_messages))
+    app.add_handler(CallbackQueryHandler(notify_callback, '^notify.*'))
+    app.add_handler(CommandHandler('del_notify', del_notify))
+    app.add_handler(CommandHandler('notify', notify))
+    app.add_handler(CommandHandler('reset', reset))
+    app.add_handler(MessageHandler(None, callback))
+    app.add_error_handler(on_error)
+
+    scheduler = Scheduler(app.job_queue, checker)
+    # workers share the bot's flood limit
+    sender = Sender(app.bot, GLOBAL_RATE / WORKERS)
+    forwarder = Forwarder(sender)
+
+    app.post_init = on_startup
+    app.post_shutdown = flush_writes
+    return app
+
+
+def main():
+    logging.basicConfig(level=os.environ.get('NANNYBOT_LOG_LEVEL', 'INFO'), format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    start_engine()
+    build_application()
+    if MODE == 'webhook':
+        import webhook
+        asyncio.run(webhook.run(app))
+    else:
+        app.run_polling()
 
-app.job_queue.run_repeating(checker, 60)
 
-app.run_polling()
+if __name__ == '__main__':
+    main()
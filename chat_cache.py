@@ -0,0 +1,65 @@
+from collections import OrderedDict
+from base import alarm_time
+
+CACHE_SIZE = 10000
+
+
+class CachedChat:
+    """What the hot path needs to know about a registered chat."""
+
+    def __init__(self, _id, period, state, last_meal):
+        self.id = _id
+        self.period = period
+        self.state = state
+        self.last_meal = last_meal
+
+    def last_meal_with(self, time):
+        if self.last_meal is None or time > self.last_meal:
+            return time
+        return self.last_meal
+
+    def next_alarm(self):
+        return alarm_time(self.last_meal, self.period)
+
+
+class ChatCache:
+    """LRU of CachedChat. Handlers write through it after every change they
+    commit, so entries never have to expire."""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._chats = OrderedDict()
+        # ids put or dropped since start_warm_up(), None when not warming up
+        self._touched = None
+
+    def get(self, _id):
+        chat = self._chats.get(_id)
+        if chat is not None:
+            self._chats.move_to_end(_id)
+        return chat
+
+    def put(self, chat):
+        if self._touched is not None:
+            self._touched.add(chat.id)
+        self._chats[chat.id] = chat
+        self._chats.move_to_end(chat.id)
+        while len(self._chats) > self.size:
+            self._chats.popitem(last=False)
+
+    def drop(self, _id):
+        if self._touched is not None:
+            self._touched.add(_id)
+        self._chats.pop(_id, None)
+
+    def start_warm_up(self):
+        self._touched = set()
+
+    def warm(self, chats):
+        """Adds chats read after start_warm_up(), except the ones handlers
+        have put or dropped since, their entries are newer."""
+        for chat in chats:
+            if chat.id not in self._touched and len(self._chats) < self.size:
+                self._chats[chat.id] = chat
+                # behind everything handlers already used
+                self._chats.move_to_end(chat.id, last=False)
+        self._touched = None
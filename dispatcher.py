@@ -0,0 +1,165 @@
+"""Runs NANNYBOT_WORKERS bot processes and routes updates between them.
+
+    NANNYBOT_WORKERS=4 python dispatcher.py
+
+Worker k is bot.py in webhook mode on NANNYBOT_WORKER_PORT + k and owns
+the chats with abs(chat_id) % NANNYBOT_WORKERS == k: it handles their
+updates and runs checker, the schedule, mutes and forwards only for them.
+The dispatcher itself takes updates from Telegram, by long polling or
+with NANNYBOT_MODE=webhook on the NANNYBOT_WEBHOOK_* address, and posts
+each one to the worker that owns its chat. Updates of one worker are
+posted one at a time, so every chat sees its updates in order.
+"""
+import os
+import sys
+import json
+import signal
+import asyncio
+import logging
+from collections import defaultdict
+
+import httpx
+from telegram import Bot, Update
+
+import base
+import webhook
+from shards import shard, WORKERS
+
+log = logging.getLogger('dispatcher')
+
+MODE = os.environ.get('NANNYBOT_MODE', 'polling')
+BOT_API_URL = os.environ.get('NANNYBOT_BOT_API_URL', 'https://api.telegram.org/bot')
+WORKER_PORT = int(os.environ.get('NANNYBOT_WORKER_PORT', webhook.WEBHOOK_PORT + 1))
+POLL_TIMEOUT = 10
+RESTART_DELAY = 1
+
+BOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+
+
+def _chat_id(update):
+    chat = update.effective_chat
+    return 0 if chat is None else chat.id
+
+
+class Worker:
+    def __init__(self, index):
+        self.index = index
+        self.url = 'http://127.0.0.1:%d%s' % (WORKER_PORT + index, webhook.WEBHOOK_PATH)
+        self._lock = asyncio.Lock()
+        self._process = None
+        self._stopping = False
+
+    def _env(self):
+        env = dict(os.environ,
+                   NANNYBOT_MODE='webhook',
+                   NANNYBOT_WORKER=str(self.index),
+                   NANNYBOT_WEBHOOK_LISTEN='127.0.0.1',
+                   NANNYBOT_WEBHOOK_PORT=str(WORKER_PORT + self.index))
+        # the dispatcher owns the public webhook
+        env.pop('NANNYBOT_WEBHOOK_URL', None)
+        env.pop('NANNYBOT_WEBHOOK_SECRET', None)
+        metrics_port = int(os.environ.get('NANNYBOT_METRICS_PORT', 0))
+        if metrics_port:
+            env['NANNYBOT_METRICS_PORT'] = str(metrics_port + self.index)
+        return env
+
+    async def supervise(self):
+        while not self._stopping:
+            self._process = await asyncio.create_subprocess_exec(sys.executable, BOT, env=self._env())
+            code = await self._process.wait()
+            if not self._stopping:
+                log.error('worker %d exited with %d, restarting', self.index, code)
+                await asyncio.sleep(RESTART_DELAY)
+
+    async def ready(self):
+        while True:
+            try:
+                _, writer = await asyncio.open_connection('127.0.0.1', WORKER_PORT + self.index)
+                writer.close()
+                return
+            except OSError:
+                await asyncio.sleep(0.1)
+
+    async def stop(self):
+        self._stopping = True
+        if self._process is not None and self._process.returncode is None:
+            self._process.terminate()
+            await self._process.wait()
+
+    async def post(self, client, bodies):
+        async with self._lock:
+            for body in bodies:
+                # a worker that is starting or restarting gets its updates once it listens
+                while True:
+                    try:
+                        response = await client.post(self.url, content=body,
+                                                     headers={'Content-Type': 'application/json'})
+                        response.raise_for_status()
+                        break
+                    except httpx.HTTPError as e:
+                        log.warning('worker %d: %s', self.index, e)
+                        await asyncio.sleep(RESTART_DELAY)
+
+
+class DispatchServer(webhook.WebhookServer):
+    """Public webhook that passes the raw body on along with its chat id."""
+
+    def decode(self, body):
+        return _chat_id(Update.de_json(json.loads(body), self._bot)), body
+
+
+async def poll(bot, route):
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, read_timeout=POLL_TIMEOUT + 5)
+        except Exception:
+            log.exception('getUpdates failed')
+            await asyncio.sleep(RESTART_DELAY)
+            continue
+        if updates:
+            await route([(_chat_id(update), update.to_json()) for update in updates])
+            offset = updates[-1].update_id + 1
+
+
+async def main():
+    # schema changes run once here rather than racing in every worker
+    base.start_engine()
+
+    workers = [Worker(index) for index in range(WORKERS)]
+    supervisors = [asyncio.ensure_future(worker.supervise()) for worker in workers]
+    await asyncio.gather(*(worker.ready() for worker in workers))
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with httpx.AsyncClient() as client, Bot(os.environ['TELEGRAM_TOKEN'], base_url=BOT_API_URL) as bot:
+        async def route(updates):
+            batches = defaultdict(list)
+            for chat_id, body in updates:
+                batches[shard(chat_id)].append(body)
+            await asyncio.gather(*(workers[index].post(client, bodies) for index, bodies in batches.items()))
+
+        if MODE == 'webhook':
+            server = DispatchServer(bot, lambda update: route([update]))
+            await server.start()
+            if webhook.WEBHOOK_URL is not None:
+                await bot.set_webhook(webhook.WEBHOOK_URL + webhook.WEBHOOK_PATH, secret_token=webhook.WEBHOOK_SECRET,
+                                      max_connections=webhook.WEBHOOK_MAX_CONNECTIONS)
+            await stop.wait()
+            await server.stop()
+        else:
+            await bot.delete_webhook()
+            poller = asyncio.ensure_future(poll(bot, route))
+            await stop.wait()
+            poller.cancel()
+
+    await asyncio.gather(*(worker.stop() for worker in workers))
+    await asyncio.gather(*supervisors)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=os.environ.get('NANNYBOT_LOG_LEVEL', 'INFO'), format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(main())
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+from base import async_session, ForwardJob, Message
+from shards import owned
+import retention
+
+log = logging.getLogger(__name__)
+
+# forwardMessages accepts up to 100 ids
+PAGE_SIZE = 100
+# topics forwarded at the same time, messages of one topic go in order
+CONCURRENCY = 4
+
+
+@async_session
+def _start_job(session, chat_id, topic_id, archived):
+    job = session.query(ForwardJob).get((chat_id, topic_id))
+    if job is None:
+        total = archived + session.query(Message.id).filter(Message.chat_id == chat_id).filter(Message.topic_id == topic_id).count()
+        job = ForwardJob(chat_id=chat_id, topic_id=topic_id, last_message_id=0, forwarded=0, total=total)
+        session.add(job)
+    return job.last_message_id, job.forwarded, job.total
+
+
+@async_session
+def _page(session, chat_id, topic_id, last_message_id):
+    return session.query(Message.id, Message.telegram_id) \
+        .filter(Message.chat_id == chat_id) \
+        .filter(Message.topic_id == topic_id) \
+        .filter(Message.id > last_message_id) \
+        .order_by(Message.id) \
+        .limit(PAGE_SIZE) \
+        .all()
+
+
+@async_session
+def _save_progress(session, chat_id, topic_id, last_message_id, forwarded):
+    session.query(ForwardJob) \
+        .filter(ForwardJob.chat_id == chat_id) \
+        .filter(ForwardJob.topic_id == topic_id) \
+        .update({'last_message_id': last_message_id, 'forwarded': forwarded}, synchronize_session=False)
+
+
+@async_session
+def _finish_job(session, chat_id, topic_id):
+    session.query(ForwardJob) \
+        .filter(ForwardJob.chat_id == chat_id) \
+        .filter(ForwardJob.topic_id == topic_id) \
+        .delete(synchronize_session=False)
+
+
+@async_session
+def _unfinished_jobs(session):
+    return session.query(ForwardJob.chat_id, ForwardJob.topic_id).filter(owned(ForwardJob.chat_id)).all()
+
+
+class Forwarder:
+    """Forwards topics page by page in background tasks.
+
+    Progress is stored in forward_jobs after every page, so a forward that
+    was interrupted continues where it stopped, either when it is requested
+    again or at startup. Deleted messages are skipped, a forward that
+    fails is reported to the chat.
+    """
+
+    def __init__(self, sender):
+        self._sender = sender
+        self._semaphore = asyncio.Semaphore(CONCURRENCY)
+        self._running = {}
+
+    def start(self, chat_id, topic_id):
+        key = (chat_id, topic_id)
+        if key in self._running:
+            return False
+        self._running[key] = asyncio.ensure_future(self._run(chat_id, topic_id))
+        return True
+
+    async def resume(self):
+        for chat_id, topic_id in await _unfinished_jobs():
+            self.start(chat_id, topic_id)
+
+    async def _run(self, chat_id, topic_id):
+        try:
+            async with self._semaphore:
+                await self._forward(chat_id, topic_id)
+        except Exception:
+            log.exception('forwarding topic %s to %s failed', topic_id, chat_id)
+            try:
+                await self._sender.send(chat_id, 'не получилось переслать тему, попробуйте позже')
+            except Exception:
+                log.exception('telling %s about the failed forward failed', chat_id)
+        finally:
+            del self._running[(chat_id, topic_id)]
+
+    async def _forward(self, chat_id, topic_id):
+        archived = await retention.read_topic(chat_id, topic_id)
+        last_message_id, forwarded, total = await _start_job(chat_id, topic_id, len(archived))
+        skipped = 0
+        while True:
+            # archived messages are older, but merge by id to be safe
+            page = sorted(retention.after(archived, last_message_id, PAGE_SIZE) +
+                          [tuple(row) for row in await _page(chat_id, topic_id, last_message_id)])[:PAGE_SIZE]
+            if not page:
+                break
+            sent = await self._sender.forward_many(chat_id, chat_id, [telegram_id for _, telegram_id in page])
+            skipped += len(page) - len(sent)
+            last_message_id = page[-1][0]
+            forwarded += len(page)
+            await _save_progress(chat_id, topic_id, last_message_id, forwarded)
+            if len(page) == PAGE_SIZE and forwarded < total:
+                await self._sender.send(chat_id, 'переслала %d из %d' % (forwarded, total))
+        await _finish_job(chat_id, topic_id)
+        if skipped:
+            await self._sender.send(chat_id, 'не переслала %d удалённых сообщений' % (skipped,))
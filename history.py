@@ -0,0 +1,297 @@
+"""Exports and imports chats with their meals, notifies, topics and topic messages.
+
+    python history.py export DIR [--chat ID ...] [--format jsonl|csv]
+    python history.py import DIR
+
+export writes DIR/chats.jsonl, DIR/topics.jsonl, DIR/meals.jsonl,
+DIR/meal_days.jsonl, DIR/notifies.jsonl, DIR/messages.jsonl and
+DIR/archive.jsonl (or .csv) for the given chats, all chats by default.
+meal_days are the meals retention.py has rolled up, archive the messages
+it has moved to NANNYBOT_ARCHIVE_DIR. import reads whichever of them DIR
+has into the NANNYBOT_DB_URL database. Rows are streamed and written in chunks of
+CHUNK rows, one transaction each, so memory does not grow with the
+files; only the ids of imported topics and chats are kept.
+
+Chats keep their Telegram id, a chat the database already has keeps its
+own settings. meal_days are added to the days the database already has.
+Other rows get new ids and messages follow their topic to its new id, so
+importing the same files twice adds their rows twice. Archived messages
+are imported into messages_v1, the next retention run archives them
+again. Forwarding jobs, mutes and metrics are not exported.
+Run it while the bot is stopped, running bots keep their cached state
+until restarted.
+"""
+import os
+import csv
+import gzip
+import sys
+import json
+import time
+import argparse
+import datetime
+import itertools
+from sqlalchemy import select, func, Integer, DateTime, Date, or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+import base
+import retention
+from base import make_session, chunks, Chat, Meal, MealDay, Notify, Topic, Message
+
+CHUNK = 5000
+
+# file name and model, in import order: messages need the new topic ids
+TABLES = [
+    ('chats', Chat),
+    ('topics', Topic),
+    ('meals', Meal),
+    ('meal_days', MealDay),
+    ('notifies', Notify),
+    ('messages', Message),
+]
+# archived messages, exported with the columns of messages
+ARCHIVE = 'archive'
+
+
+def _dump(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def _parsers(table):
+    parsers = {}
+    for column in table.columns:
+        if isinstance(column.type, Integer):
+            parsers[column.name] = int
+        elif isinstance(column.type, DateTime):
+            parsers[column.name] = datetime.datetime.fromisoformat
+        elif isinstance(column.type, Date):
+            parsers[column.name] = datetime.date.fromisoformat
+        else:
+            parsers[column.name] = str
+    return parsers
+
+
+def _parse(row, parsers, csv_format):
+    result = {}
+    for name, value in row.items():
+        # csv has no null, an empty string stands for it
+        if csv_format and value == '':
+            value = None
+        result[name] = parsers[name](value) if isinstance(value, str) else value
+    return result
+
+
+def _write_jsonl(path, names, rows):
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for row in rows:
+            f.write(json.dumps(dict(zip(names, map(_dump, row))), ensure_ascii=False) + '\n')
+            count += 1
+    return count
+
+
+def _write_csv(path, names, rows):
+    count = 0
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        for row in rows:
+            writer.writerow(['' if value is None else _dump(value) for value in row])
+            count += 1
+    return count
+
+
+def _read_jsonl(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _read_csv(path):
+    with open(path, encoding='utf-8', newline='') as f:
+        yield from csv.DictReader(f)
+
+
+FORMATS = {
+    'jsonl': (_write_jsonl, _read_jsonl),
+    'csv': (_write_csv, _read_csv),
+}
+
+
+def _query(model, chat_ids, archived_topics):
+    table = model.__table__
+    query = select(table).order_by(*table.primary_key)
+    if chat_ids:
+        if model is Chat:
+            query = query.where(Chat.id.in_(chat_ids))
+        elif model is Topic:
+            # closed topics have no chat_id, their messages still do
+            query = query.where(or_(Topic.chat_id.in_(chat_ids),
+                                    Topic.id.in_(select(Message.topic_id).where(Message.chat_id.in_(chat_ids))),
+                                    Topic.id.in_(archived_topics)))
+        else:
+            query = query.where(table.c.chat_id.in_(chat_ids))
+    return query
+
+
+def _report(name, count, start):
+    elapsed = time.monotonic() - start
+    print('%-9s %9d rows %7.2fs %9.0f rows/s' % (name, count, elapsed, count / elapsed if elapsed else 0), file=sys.stderr)
+
+
+def _archives(chat_ids):
+    if chat_ids:
+        return [chat_id for chat_id in chat_ids if os.path.exists(retention._archive_path(chat_id))]
+    if not os.path.isdir(retention.ARCHIVE_DIR):
+        return []
+    return sorted(int(name[:-len('.jsonl.gz')]) for name in os.listdir(retention.ARCHIVE_DIR) if name.endswith('.jsonl.gz'))
+
+
+def _archived(chat_ids, names, topic_ids):
+    """Rows of the archive files of the chats, adds their topics to topic_ids."""
+    for chat_id in _archives(chat_ids):
+        # a crash between archiving and deleting writes a batch twice, see _read_topic()
+        seen = set()
+        with gzip.open(retention._archive_path(chat_id), 'rt', encoding='utf-8') as f:
+            for line in f:
+                message = json.loads(line)
+                if message['id'] in seen:
+                    continue
+                seen.add(message['id'])
+                topic_ids.add(message['topic_id'])
+                message['chat_id'] = chat_id
+                yield [message[name] for name in names]
+
+
+def export(directory, chat_ids, fmt):
+    write, _ = FORMATS[fmt]
+    os.makedirs(directory, exist_ok=True)
+    # the archive goes first, it names closed topics the messages table may no longer have
+    start = time.monotonic()
+    names = [column.name for column in Message.__table__.columns]
+    archived_topics = set()
+    count = write(os.path.join(directory, '%s.%s' % (ARCHIVE, fmt)), names, _archived(chat_ids, names, archived_topics))
+    _report(ARCHIVE, count, start)
+    for name, model in TABLES:
+        start = time.monotonic()
+        with base.Engine.connect() as conn:
+            query = _query(model, chat_ids, sorted(archived_topics))
+            result = conn.execution_options(stream_results=True).execute(query)
+            rows = (row for partition in result.partitions(CHUNK) for row in partition)
+            count = write(os.path.join(directory, '%s.%s' % (name, fmt)), list(result.keys()), rows)
+        _report(name, count, start)
+
+
+def _next_id(conn, model):
+    return (conn.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+def _refresh_chats(chat_ids):
+    # last_meal and next_alarm are kept on the chat, see migrate()
+    with make_session() as session:
+        for chunk in chunks(sorted(chat_ids)):
+            last_meals = dict(session.query(Meal.chat_id, func.max(Meal.time))
+                              .filter(Meal.chat_id.in_(chunk)).group_by(Meal.chat_id))
+            for chat in session.query(Chat).filter(Chat.id.in_(chunk)):
+                chat.last_meal = last_meals.get(chat.id)
+                chat.update_alarm()
+
+
+def _renumber(model, chunk, conn, topic_ids):
+    """Gives the rows of a chunk their ids in this database."""
+    if model is Chat:
+        for row in chunk:
+            # the topic a chat was adding to is not imported yet, see ChatState
+            row['state'] = None
+        return chunk
+    if model is Topic:
+        # set here rather than by the insert, messages need them before it
+        next_id = _next_id(conn, model)
+        for row in chunk:
+            topic_ids[row['id']] = next_id
+            row['id'] = next_id
+            next_id += 1
+        return chunk
+    if model is MealDay:
+        return chunk
+    for row in chunk:
+        del row['id']
+        if model is Message:
+            row['topic_id'] = topic_ids.get(row['topic_id'])
+    if model is Message:
+        # a message without its topic could neither be viewed nor found
+        return [row for row in chunk if row['topic_id'] is not None]
+    return chunk
+
+
+def _insert(model):
+    table = model.__table__
+    if model is Chat:
+        # a chat the database has already keeps its settings
+        return table.insert().prefix_with('OR IGNORE')
+    if model is MealDay:
+        insert = sqlite_insert(table)
+        return insert.on_conflict_do_update(index_elements=list(table.primary_key), set_={
+            'amount': table.c.amount + insert.excluded.amount,
+            'count': table.c.count + insert.excluded.count,
+        })
+    return table.insert()
+
+
+def import_(directory):
+    topic_ids = {}
+    chat_ids = set()
+    for name, model in TABLES + [(ARCHIVE, Message)]:
+        for fmt, (_, read) in FORMATS.items():
+            path = os.path.join(directory, '%s.%s' % (name, fmt))
+            if os.path.exists(path):
+                break
+        else:
+            continue
+
+        table = model.__table__
+        insert = _insert(model)
+        parsers = _parsers(table)
+        start = time.monotonic()
+        count = skipped = 0
+        rows = (_parse(row, parsers, fmt == 'csv') for row in read(path))
+        while True:
+            chunk = list(itertools.islice(rows, CHUNK))
+            if not chunk:
+                break
+            with base.Engine.begin() as conn:
+                kept = _renumber(model, chunk, conn, topic_ids)
+                if kept:
+                    conn.execute(insert, kept)
+            skipped += len(chunk) - len(kept)
+            count += len(kept)
+            if model is Meal:
+                chat_ids.update(row['chat_id'] for row in kept)
+        _report(name, count, start)
+        if skipped:
+            print('skipped %d %s whose topic is missing from %s' % (skipped, name, directory), file=sys.stderr)
+    _refresh_chats(chat_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export')
+    export_parser.add_argument('directory')
+    export_parser.add_argument('--chat', type=int, action='append', default=[], help='export only this chat, repeatable')
+    export_parser.add_argument('--format', choices=FORMATS, default='jsonl')
+    import_parser = commands.add_parser('import')
+    import_parser.add_argument('directory')
+    args = parser.parse_args()
+
+    base.start_engine()
+    if args.command == 'export':
+        export(args.directory, args.chat, args.format)
+    else:
+        import_(args.directory)
+
+
+if __name__ == '__main__':
+    main()
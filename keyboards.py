@@ -0,0 +1,50 @@
+from collections import OrderedDict
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+
+CACHE_SIZE = 10000
+# buttons per page, Telegram rejects keyboards past 100 buttons and a long list is unusable anyway
+PAGE_SIZE = 8
+
+
+def paginate(buttons, page_data, extra=()):
+    """Splits (label, callback_data) pairs into keyboards of PAGE_SIZE
+    buttons with prev/next buttons whose callback data is page_data(page).
+    Rows in extra are added to every page."""
+    pages = [buttons[i:i + PAGE_SIZE] for i in range(0, len(buttons), PAGE_SIZE)] or [[]]
+    markups = []
+    for page, page_buttons in enumerate(pages):
+        rows = [[InlineKeyboardButton(label, callback_data=data)] for label, data in page_buttons]
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton('‹ назад', callback_data=page_data(page - 1)))
+        if page < len(pages) - 1:
+            navigation.append(InlineKeyboardButton('дальше ›', callback_data=page_data(page + 1)))
+        if navigation:
+            rows.append(navigation)
+        markups.append(InlineKeyboardMarkup(rows + list(extra)))
+    return markups
+
+
+class MenuCache:
+    """LRU of the paginated menus of a chat, by menu name. Handlers drop a
+    chat's menus whenever they change the topics or notifies behind them."""
+
+    def __init__(self, size=CACHE_SIZE):
+        self._size = size
+        self._chats = OrderedDict()
+
+    def get(self, chat_id, menu):
+        menus = self._chats.get(chat_id)
+        if menus is None:
+            return None
+        self._chats.move_to_end(chat_id)
+        return menus.get(menu)
+
+    def put(self, chat_id, menu, pages):
+        self._chats.setdefault(chat_id, {})[menu] = pages
+        self._chats.move_to_end(chat_id)
+        while len(self._chats) > self._size:
+            self._chats.popitem(last=False)
+
+    def drop(self, chat_id):
+        self._chats.pop(chat_id, None)
@@ -0,0 +1,98 @@
+import os
+import asyncio
+import logging
+from collections import deque
+from telegram.ext import Application
+
+log = logging.getLogger(__name__)
+
+# updates accepted but not yet handled, fetching stops at this many and
+# webhook requests and polling then wait on the update queue of this size
+MAX_IN_FLIGHT = int(os.environ.get('NANNYBOT_MAX_IN_FLIGHT', 256))
+# of those, at most this many per chat
+MAX_PER_CHAT = int(os.environ.get('NANNYBOT_MAX_PER_CHAT', 16))
+
+
+class ChatLanes:
+    """Runs the coroutines of one key one after another in the order they
+    were submitted, and coroutines of different keys concurrently.
+
+    A lane is a task that exists while its key has work queued, so idle
+    chats cost nothing. submit() waits while `limit` coroutines are queued
+    or running, which holds the caller back instead of buffering forever.
+    One key holds at most `per_lane` of those slots; its coroutines past
+    that wait in a separate pool of `limit` overflow slots, so a flood
+    from one chat delays other chats only once that pool is full too.
+    """
+
+    def __init__(self, limit=MAX_IN_FLIGHT, per_lane=MAX_PER_CHAT):
+        self._lanes = {}
+        self._slots = {}
+        self._tasks = set()
+        self._per_lane = per_lane
+        self._free = asyncio.Semaphore(limit)
+        self._overflow = asyncio.Semaphore(limit)
+
+    async def submit(self, key, coroutine):
+        if self._slots.get(key, 0) < self._per_lane:
+            pool = self._free
+            self._slots[key] = self._slots.get(key, 0) + 1
+        else:
+            pool = self._overflow
+        try:
+            await pool.acquire()
+        except BaseException:
+            if pool is self._free:
+                self._release_slot(key)
+            raise
+        lane = self._lanes.get(key)
+        if lane is not None:
+            lane.append((coroutine, pool))
+            return
+        self._lanes[key] = deque()
+        task = asyncio.ensure_future(self._drain(key, coroutine, pool))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _release_slot(self, key):
+        self._slots[key] -= 1
+        if self._slots[key] == 0:
+            del self._slots[key]
+
+    async def _drain(self, key, coroutine, pool):
+        lane = self._lanes[key]
+        while True:
+            try:
+                await coroutine
+            except Exception:
+                log.exception('update for chat %s failed', key)
+            finally:
+                pool.release()
+                if pool is self._free:
+                    self._release_slot(key)
+            if not lane:
+                del self._lanes[key]
+                return
+            coroutine, pool = lane.popleft()
+
+    async def join(self):
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+
+
+class LaneApplication(Application):
+    """Application that handles updates of different chats concurrently and
+    the updates of one chat strictly in the order they arrived, since
+    handlers depend on the ChatState earlier updates left behind."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.lanes = ChatLanes()
+
+    async def process_update(self, update):
+        chat = getattr(update, 'effective_chat', None)
+        await self.lanes.submit(None if chat is None else chat.id, super().process_update(update))
+
+    async def stop(self):
+        await super().stop()
+        await self.lanes.join()
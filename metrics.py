@@ -0,0 +1,189 @@
+import os
+import time
+import asyncio
+import functools
+import threading
+import contextvars
+
+METRICS_HOST = os.environ.get('NANNYBOT_METRICS_HOST', '127.0.0.1')
+# 0 disables the endpoint
+METRICS_PORT = int(os.environ.get('NANNYBOT_METRICS_PORT', 0))
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 1000)
+
+_registry = []
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in labels)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            lines.extend(self._render(labels, value))
+        return lines
+
+    def _render(self, labels, value):
+        return ['%s%s %s' % (self.name, _format_labels(labels), value)]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_labels(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = _labels(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one slot per bucket, then +Inf and the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-2] += 1
+            counts[-1] += value
+
+    def _render(self, labels, counts):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            total += count
+            lines.append('%s_bucket%s %d' % (self.name, _format_labels(labels + (('le', bound),)), total))
+        lines.append('%s_sum%s %s' % (self.name, _format_labels(labels), counts[-1]))
+        lines.append('%s_count%s %d' % (self.name, _format_labels(labels), total))
+        return lines
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+handler_seconds = Histogram('nannybot_handler_seconds', 'Handler latency')
+handler_errors = Counter('nannybot_handler_errors_total', 'Handlers that raised')
+update_queries = Histogram('nannybot_update_db_queries', 'SQL statements per update', COUNT_BUCKETS)
+update_db_seconds = Histogram('nannybot_update_db_seconds', 'Time spent in SQL per update')
+db_queries = Counter('nannybot_db_queries_total', 'SQL statements')
+db_seconds = Histogram('nannybot_db_query_seconds', 'SQL statement latency')
+checker_seconds = Histogram('nannybot_checker_seconds', 'checker run time')
+due_alarms = Gauge('nannybot_due_alarms', 'Notifies and feeding alarms due in the last checker run')
+send_seconds = Histogram('nannybot_send_seconds', 'Bot API call latency')
+send_errors = Counter('nannybot_send_errors_total', 'Failed Bot API calls')
+
+
+class _UpdateStats:
+    __slots__ = ('queries', 'seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.
+
+
+_update_stats = contextvars.ContextVar('update_stats', default=None)
+
+
+def timed(func):
+    """Records latency and SQL statements of a handler."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        stats = _UpdateStats()
+        token = _update_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, handler=name)
+            update_queries.observe(stats.queries, handler=name)
+            update_db_seconds.observe(stats.seconds, handler=name)
+            _update_stats.reset(token)
+    return wrapper
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    db_queries.inc()
+    db_seconds.observe(elapsed)
+    stats = _update_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.seconds += elapsed
+
+
+def watch_engine(engine):
+    from sqlalchemy import event
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+async def _respond(reader, writer):
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+        body = render().encode()
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: %d\r\n'
+                     b'Connection: close\r\n\r\n' % len(body) + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(host=METRICS_HOST, port=METRICS_PORT):
+    """Serves render() on http://host:port/ for Prometheus."""
+    if port == 0:
+        return None
+    return await asyncio.start_server(_respond, host, port)
@@ -0,0 +1,51 @@
+import heapq
+import datetime
+from base import async_session, chunks, Mute
+from shards import owned
+
+
+@async_session
+def _store(session, mutes, now):
+    # replacing the rows takes a few statements however many chats are muted, merge() takes two per chat
+    for chunk in chunks(list(mutes)):
+        session.query(Mute).filter(Mute.chat_id.in_(chunk)).delete(synchronize_session=False)
+    session.bulk_insert_mappings(Mute, [{'chat_id': chat_id, 'until': until} for chat_id, until in mutes.items()])
+    session.query(Mute).filter(Mute.until <= now).delete(synchronize_session=False)
+
+
+class MuteStore:
+    """Chats muted until some time, kept in the mutes table so they survive
+    restarts. Expired mutes are evicted through an expiry-ordered heap."""
+
+    def __init__(self):
+        self._until = {}
+        self._heap = []
+
+    def load(self, session):
+        now = datetime.datetime.utcnow()
+        session.query(Mute).filter(Mute.until <= now).delete(synchronize_session=False)
+        for chat_id, until in session.query(Mute.chat_id, Mute.until).filter(owned(Mute.chat_id)):
+            self._set(chat_id, until)
+
+    def _set(self, chat_id, until):
+        self._until[chat_id] = until
+        heapq.heappush(self._heap, (until, chat_id))
+
+    def _evict(self, now):
+        while self._heap and self._heap[0][0] <= now:
+            until, chat_id = heapq.heappop(self._heap)
+            if self._until.get(chat_id) == until:
+                del self._until[chat_id]
+
+    def muted(self, chat_ids, now):
+        """Returns {chat_id: until} for the chats among chat_ids that are muted at now."""
+        self._evict(now)
+        return {chat_id: self._until[chat_id] for chat_id in chat_ids if chat_id in self._until}
+
+    async def mute(self, mutes, now):
+        if not mutes:
+            return
+        await _store(mutes, now)
+        for chat_id, until in mutes.items():
+            self._set(chat_id, until)
+        self._evict(now)
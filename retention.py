@@ -0,0 +1,170 @@
+import os
+import gzip
+import json
+import bisect
+import asyncio
+import logging
+import datetime
+from collections import defaultdict
+from sqlalchemy import func
+from base import async_session, Meal, MealDay, Message
+from shards import owned
+
+log = logging.getLogger(__name__)
+
+# meals older than this are rolled up into meal_days
+MEAL_RETENTION_DAYS = int(os.environ.get('NANNYBOT_MEAL_RETENTION_DAYS', 90))
+# topic messages older than this move to the archive
+MESSAGE_RETENTION_DAYS = int(os.environ.get('NANNYBOT_MESSAGE_RETENTION_DAYS', 180))
+ARCHIVE_DIR = os.environ.get('NANNYBOT_ARCHIVE_DIR', 'archive')
+MAINTENANCE_INTERVAL = datetime.timedelta(hours=int(os.environ.get('NANNYBOT_MAINTENANCE_HOURS', 6)))
+# rows per transaction, with a pause in between so handlers get the db thread
+BATCH = 500
+PAUSE = 0.5
+
+
+@async_session
+def _roll_up_meals(session, cutoff):
+    ids = [_id for _id, in session.query(Meal.id)
+           .filter(Meal.time < cutoff).filter(owned(Meal.chat_id))
+           .order_by(Meal.id).limit(BATCH)]
+    if not ids:
+        return 0
+    day = func.date(Meal.time)
+    rows = session.query(Meal.chat_id, day, func.sum(Meal.amount), func.count(Meal.id)) \
+        .filter(Meal.id.in_(ids)) \
+        .group_by(Meal.chat_id, day)
+    rows = [(chat_id, datetime.date.fromisoformat(day), amount, count) for chat_id, day, amount, count in rows]
+    # the summaries these days already have, in one query
+    existing = {(summary.chat_id, summary.day): summary for summary in session.query(MealDay)
+                .filter(MealDay.chat_id.in_({row[0] for row in rows}))
+                .filter(MealDay.day.in_({row[1] for row in rows}))}
+    for chat_id, day, amount, count in rows:
+        summary = existing.get((chat_id, day))
+        if summary is None:
+            session.add(MealDay(chat_id=chat_id, day=day, amount=amount, count=count))
+        else:
+            summary.amount += amount
+            summary.count += count
+    session.query(Meal).filter(Meal.id.in_(ids)).delete(synchronize_session=False)
+    return len(ids)
+
+
+@async_session
+def _old_messages(session, cutoff):
+    return session.query(Message.id, Message.chat_id, Message.topic_id, Message.telegram_id, Message.content, Message.time) \
+        .filter(Message.time < cutoff) \
+        .filter(owned(Message.chat_id)) \
+        .order_by(Message.id) \
+        .limit(BATCH) \
+        .all()
+
+
+@async_session
+def _delete_messages(session, ids):
+    session.query(Message).filter(Message.id.in_(ids)).delete(synchronize_session=False)
+
+
+def _archive_path(chat_id):
+    return os.path.join(ARCHIVE_DIR, '%d.jsonl.gz' % (chat_id,))
+
+
+def _append(chat_id, rows):
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    # every append is a gzip member of its own, readers see them as one stream
+    with gzip.open(_archive_path(chat_id), 'at', encoding='utf-8') as f:
+        for _id, _, topic_id, telegram_id, content, time in rows:
+            f.write(json.dumps({'id': _id, 'topic_id': topic_id, 'telegram_id': telegram_id,
+                                'content': content, 'time': time.isoformat()}, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _archive(rows):
+    by_chat = defaultdict(list)
+    for row in rows:
+        by_chat[row[1]].append(row)
+    for chat_id, chat_rows in by_chat.items():
+        _append(chat_id, chat_rows)
+
+
+def renumber_topics(topic_ids):
+    """Rewrites the topic ids of all archived messages with the topic_ids
+    dict, ids it does not have stay as they are. Files are replaced whole,
+    so running it again after a crash is safe."""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return
+    for name in os.listdir(ARCHIVE_DIR):
+        if not name.endswith('.jsonl.gz'):
+            continue
+        path = os.path.join(ARCHIVE_DIR, name)
+        with gzip.open(path, 'rt', encoding='utf-8') as src, gzip.open(path + '.tmp', 'wt', encoding='utf-8') as dst:
+            for line in src:
+                message = json.loads(line)
+                message['topic_id'] = topic_ids.get(message['topic_id'], message['topic_id'])
+                dst.write(json.dumps(message, ensure_ascii=False) + '\n')
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(path + '.tmp', path)
+
+
+def _read_topic(chat_id, topic_id):
+    path = _archive_path(chat_id)
+    if not os.path.exists(path):
+        return []
+    messages = {}
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            message = json.loads(line)
+            if message['topic_id'] == topic_id:
+                messages[message['id']] = message['telegram_id']
+    return sorted(messages.items())
+
+
+async def read_topic(chat_id, topic_id):
+    """Sorted (id, telegram_id) of the archived messages of a topic."""
+    return await asyncio.get_running_loop().run_in_executor(None, _read_topic, chat_id, topic_id)
+
+
+def after(archived, last_message_id, limit):
+    start = bisect.bisect_right(archived, (last_message_id, float('inf')))
+    return archived[start:start + limit]
+
+
+async def roll_up_meals(now):
+    cutoff = now - datetime.timedelta(days=MEAL_RETENTION_DAYS)
+    total = 0
+    while True:
+        count = await _roll_up_meals(cutoff)
+        total += count
+        if count < BATCH:
+            return total
+        await asyncio.sleep(PAUSE)
+
+
+async def archive_messages(now):
+    cutoff = now - datetime.timedelta(days=MESSAGE_RETENTION_DAYS)
+    loop = asyncio.get_running_loop()
+    total = 0
+    while True:
+        rows = await _old_messages(cutoff)
+        if rows:
+            # written before the rows are deleted: a crash in between leaves
+            # duplicates in the archive, which readers drop by id
+            await loop.run_in_executor(None, _archive, rows)
+            await _delete_messages([row[0] for row in rows])
+        total += len(rows)
+        if len(rows) < BATCH:
+            return total
+        await asyncio.sleep(PAUSE)
+
+
+async def maintain(_=None):
+    """Job queue callback that keeps the hot tables small."""
+    now = datetime.datetime.utcnow()
+    try:
+        meals = await roll_up_meals(now)
+        messages = await archive_messages(now)
+        log.info('rolled up %d meals, archived %d messages', meals, messages)
+    except Exception:
+        log.exception('maintenance failed')
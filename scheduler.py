@@ -0,0 +1,91 @@
+import heapq
+import datetime
+import logging
+
+log = logging.getLogger(__name__)
+
+RETRY_DELAY = datetime.timedelta(seconds=60)
+
+
+class Scheduler:
+    """Keeps due times of notifies and feeding alarms in a heap and arms
+    a single job queue wakeup for the earliest one.
+
+    Keys are tuples like ('notify', id) or ('chat', id). Rescheduling or
+    cancelling a key leaves the old heap entry behind, it is dropped lazily
+    once it reaches the top of the heap. Runs never overlap: while the
+    callback runs nothing is armed, the earliest key is armed once it
+    returns.
+    """
+
+    def __init__(self, job_queue, callback):
+        self._job_queue = job_queue
+        self._callback = callback
+        self._heap = []
+        self._due = {}
+        self._job = None
+        self._armed = None
+        self._running = False
+
+    def schedule(self, key, due):
+        if due is None:
+            self.cancel(key)
+            return
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, key))
+        self._arm()
+
+    def load(self, items):
+        # keys scheduled since the items were read are newer
+        for key, due in items:
+            if due is not None and key not in self._due:
+                self._due[key] = due
+                self._heap.append((due, key))
+        heapq.heapify(self._heap)
+        self._arm()
+
+    def cancel(self, key):
+        # a wakeup armed for a cancelled key just finds nothing to do
+        self._due.pop(key, None)
+
+    def next_due(self):
+        while self._heap:
+            due, key = self._heap[0]
+            if self._due.get(key) == due:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    def _pop_due(self, now):
+        due = self.next_due()
+        while due is not None and due <= now:
+            _, key = heapq.heappop(self._heap)
+            del self._due[key]
+            due = self.next_due()
+
+    def _arm(self):
+        if self._running:
+            return
+        due = self.next_due()
+        if due is None or (self._armed is not None and self._armed <= due):
+            return
+        if self._job is not None:
+            self._job.schedule_removal()
+        delay = max(0., (due - datetime.datetime.utcnow()).total_seconds())
+        self._armed = due
+        self._job = self._job_queue.run_once(self._fire, delay)
+
+    async def _fire(self, context):
+        self._job = None
+        self._armed = None
+        now = datetime.datetime.utcnow()
+        self._pop_due(now)
+        self._running = True
+        try:
+            await self._callback(context)
+        except Exception:
+            log.exception('scheduled check failed')
+            self.schedule(('retry',), now + RETRY_DELAY)
+        finally:
+            self._running = False
+        self._arm()
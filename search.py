@@ -0,0 +1,92 @@
+"""Full-text search over the messages of open topics, sqlite only.
+
+messages_fts is a contentless FTS5 index: it keeps the tokens but not the
+text, results are joined back to messages_v1. Triggers keep it in sync,
+so bulk inserts from the write buffer, deletes by retention.py and
+closing a topic need no code of their own. Every row also indexes a
+token for its chat, which makes a chat's matches a posting list
+intersection rather than a scan over the matches of all chats.
+"""
+from sqlalchemy import text, DateTime
+from base import async_session
+
+# matches per /search reply, and characters shown of each
+LIMIT = 10
+PREVIEW = 200
+
+
+def _chat_token(column):
+    # tokenizers split on '-', group chat ids are negative
+    return "(CASE WHEN {0} < 0 THEN 'g' || -{0} ELSE 'c' || {0} END)".format(column)
+
+
+def chat_token(chat_id):
+    return 'g%d' % (-chat_id,) if chat_id < 0 else 'c%d' % (chat_id,)
+
+
+# a lookup by primary key, IN (SELECT ...) would build the set of open topics on every row
+_OPEN_TOPIC = 'EXISTS (SELECT 1 FROM topics WHERE id = {0}.topic_id AND chat_id IS NOT NULL)'
+
+# a contentless index only forgets a row when given the values it indexed
+DDL = [
+    "CREATE VIRTUAL TABLE messages_fts USING fts5(content, chat, content='')",
+    "INSERT INTO messages_fts (rowid, content, chat) "
+    "SELECT id, content, %s FROM messages_v1 m WHERE %s" % (_chat_token('chat_id'), _OPEN_TOPIC.format('m')),
+    "CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages_v1 WHEN %s BEGIN "
+    "INSERT INTO messages_fts (rowid, content, chat) VALUES (new.id, new.content, %s); END"
+    % (_OPEN_TOPIC.format('new'), _chat_token('new.chat_id')),
+    "CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages_v1 WHEN %s BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, content, chat) VALUES ('delete', old.id, old.content, %s); END"
+    % (_OPEN_TOPIC.format('old'), _chat_token('old.chat_id')),
+    "CREATE TRIGGER messages_fts_update AFTER UPDATE OF content, chat_id, topic_id ON messages_v1 BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, content, chat) SELECT 'delete', old.id, old.content, %s WHERE %s; "
+    "INSERT INTO messages_fts (rowid, content, chat) SELECT new.id, new.content, %s WHERE %s; END"
+    % (_chat_token('old.chat_id'), _OPEN_TOPIC.format('old'), _chat_token('new.chat_id'), _OPEN_TOPIC.format('new')),
+    # closing a topic sets its chat_id to NULL and takes its messages out of search
+    "CREATE TRIGGER topics_fts_close AFTER UPDATE OF chat_id ON topics "
+    "WHEN old.chat_id IS NOT NULL AND new.chat_id IS NULL BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, content, chat) "
+    "SELECT 'delete', id, content, %s FROM messages_v1 WHERE topic_id = old.id; END" % (_chat_token('chat_id'),),
+]
+
+
+def create_index(engine):
+    """Creates and fills messages_fts and its triggers unless they exist."""
+    with engine.begin() as conn:
+        if conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").first() is not None:
+            return
+        # pysqlite would commit before every CREATE otherwise
+        conn.exec_driver_sql('BEGIN')
+        for statement in DDL:
+            conn.exec_driver_sql(statement)
+
+
+def _term(word):
+    # a prefix expands to every matching token of all chats, so only on request
+    prefix = word.endswith('*') and len(word) > 1
+    if prefix:
+        word = word[:-1]
+    return '"%s"%s' % (word.replace('"', '""'), '*' if prefix else '')
+
+
+def match_query(chat_id, words):
+    """FTS5 query for messages of the chat with all the words, 'word*'
+    also matches longer words. Words are quoted, so operators and
+    punctuation typed by the user are searched for as text."""
+    return 'chat:%s AND (%s)' % (chat_token(chat_id), ' '.join(_term(word) for word in words))
+
+
+# the chat column matches every row of the chat equally, only content is ranked
+_SEARCH = text(
+    "SELECT t.name, m.content, m.time FROM "
+    "(SELECT rowid, bm25(messages_fts, 1.0, 0.0) AS score FROM messages_fts "
+    " WHERE messages_fts MATCH :query ORDER BY score LIMIT :limit) AS f "
+    "JOIN messages_v1 m ON m.id = f.rowid "
+    "JOIN topics t ON t.id = m.topic_id "
+    "ORDER BY f.score").columns(time=DateTime)
+
+
+@async_session
+def search(session, chat_id, words, limit=LIMIT):
+    """(topic name, content, time) of the best matches, best first."""
+    return session.execute(_SEARCH, {'query': match_query(chat_id, words), 'limit': limit}).all()
@@ -0,0 +1,138 @@
+import os
+import time
+import asyncio
+import logging
+from telegram.error import RetryAfter, BadRequest, NetworkError
+from metrics import send_seconds, send_errors
+
+log = logging.getLogger(__name__)
+
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_RATE = float(os.environ.get('NANNYBOT_SEND_RATE', 30))
+CHAT_RATE = float(os.environ.get('NANNYBOT_SEND_CHAT_RATE', 1))
+CHAT_BURST = 3
+CONCURRENCY = int(os.environ.get('NANNYBOT_SEND_CONCURRENCY', 8))
+RETRIES = 5
+BACKOFF = 0.5
+MAX_IDLE_BUCKETS = 1000
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Sender:
+    """Outbound Telegram calls with bounded concurrency, global and per-chat
+    rate limits and retries on flood control and network errors."""
+
+    def __init__(self, bot, rate=GLOBAL_RATE):
+        self._bot = bot
+        self._semaphore = asyncio.Semaphore(CONCURRENCY)
+        self._global = TokenBucket(rate, rate)
+        self._chats = {}
+        self._prune_at = MAX_IDLE_BUCKETS
+
+    def _chat_bucket(self, chat_id):
+        if chat_id not in self._chats:
+            if len(self._chats) > self._prune_at:
+                self._chats = {key: bucket for key, bucket in self._chats.items() if not bucket.full()}
+                # a digest to thousands of chats keeps them all busy, scanning again
+                # on the next new chat would make sending it quadratic
+                self._prune_at = max(MAX_IDLE_BUCKETS, 2 * len(self._chats))
+            self._chats[chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST)
+        return self._chats[chat_id]
+
+    async def call(self, chat_id, method, *args, **kwargs):
+        for attempt in range(RETRIES):
+            await self._chat_bucket(chat_id).acquire()
+            async with self._semaphore:
+                await self._global.acquire()
+                start = time.perf_counter()
+                try:
+                    return await method(*args, **kwargs)
+                except RetryAfter as e:
+                    send_errors.inc(method=method.__name__, error='RetryAfter')
+                    delay = e.retry_after
+                except BadRequest:
+                    send_errors.inc(method=method.__name__, error='BadRequest')
+                    raise
+                except NetworkError as e:
+                    send_errors.inc(method=method.__name__, error=type(e).__name__)
+                    delay = BACKOFF * 2 ** attempt
+                    if attempt == RETRIES - 1:
+                        raise
+                finally:
+                    send_seconds.observe(time.perf_counter() - start, method=method.__name__)
+            log.warning('retrying %s for chat %s in %ss', method.__name__, chat_id, delay)
+            await asyncio.sleep(delay)
+        raise RetryAfter(delay)
+
+    async def send(self, chat_id, text, **kwargs):
+        return await self.call(chat_id, self._bot.send_message, chat_id, text, **kwargs)
+
+    async def reply(self, message, text, **kwargs):
+        # same quoting as Message.reply_text
+        if message.chat.type != 'private':
+            kwargs.setdefault('reply_to_message_id', message.message_id)
+        return await self.send(message.chat.id, text, **kwargs)
+
+    async def edit_markup(self, message, reply_markup):
+        return await self.call(message.chat.id, self._bot.edit_message_reply_markup,
+                               message.chat.id, message.message_id, reply_markup=reply_markup)
+
+    async def forward(self, chat_id, from_chat_id, message_id):
+        return await self.call(chat_id, self._bot.forward_message, chat_id, from_chat_id, message_id)
+
+    async def forward_many(self, chat_id, from_chat_id, message_ids):
+        # forwardMessages keeps the order and costs one request, python-telegram-bot has it since 20.8
+        forward_messages = getattr(self._bot, 'forward_messages', None)
+        if forward_messages is not None:
+            return await self.call(chat_id, forward_messages, chat_id, from_chat_id, message_ids)
+        # like forwardMessages, skip messages that were deleted and return the ones forwarded
+        forwarded = []
+        for message_id in message_ids:
+            try:
+                forwarded.append(await self.forward(chat_id, from_chat_id, message_id))
+            except BadRequest as e:
+                log.warning('skipping message %s of chat %s: %s', message_id, from_chat_id, e)
+        return forwarded
+
+    async def send_digest(self, messages):
+        """Sends all messages for a chat as one message, chats concurrently.
+
+        Returns the ids of the chats that could not be reached.
+        """
+        chat_ids = []
+        sends = []
+        for chat_id, texts in messages.items():
+            text = '\n'.join(text for text in texts if text != '')
+            if text != '':
+                chat_ids.append(chat_id)
+                sends.append(self.send(chat_id, text))
+        failed = set()
+        for chat_id, result in zip(chat_ids, await asyncio.gather(*sends, return_exceptions=True)):
+            if isinstance(result, Exception):
+                log.error('failed to send to %s: %s', chat_id, result)
+                failed.add(chat_id)
+        return failed
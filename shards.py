@@ -0,0 +1,18 @@
+import os
+from sqlalchemy import func, true
+
+# number of worker processes and the index of this one, see dispatcher.py
+WORKERS = int(os.environ.get('NANNYBOT_WORKERS', 1))
+WORKER = int(os.environ.get('NANNYBOT_WORKER', 0))
+
+
+def shard(chat_id, workers=WORKERS):
+    # group chat ids are negative
+    return abs(chat_id) % workers
+
+
+def owned(column):
+    """SQL condition matching the rows whose chat id column belongs to this worker."""
+    if WORKERS == 1:
+        return true()
+    return func.abs(column) % WORKERS == WORKER
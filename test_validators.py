@@ -0,0 +1,39 @@
+import datetime
+from validators import parse_message, validate_period, validate_delta, format_period, MealEntry, TextEntry
+
+HOUR = datetime.timedelta(hours=1)
+
+
+def test_meal():
+    assert parse_message('120') == MealEntry(120, datetime.timedelta())
+    # surrounding spaces are ignored, int() ignored them before too
+    assert parse_message(' 120 ') == MealEntry(120, datetime.timedelta())
+
+
+def test_delayed_meal():
+    assert parse_message('-1h 120') == MealEntry(120, -HOUR)
+    assert parse_message('-30m 90') == MealEntry(90, datetime.timedelta(minutes=-30))
+    assert parse_message('1h 120') == MealEntry(120, HOUR)
+    # split(' ') used to reject these
+    assert parse_message(' -1h 120') == MealEntry(120, -HOUR)
+    assert parse_message('1h 120 ') == MealEntry(120, HOUR)
+
+
+def test_text():
+    for content in ['', 'привет', '120 мл', '-1h', '-1h  120', '-1d 120', '3:0:0', '1_000', '12.5']:
+        assert parse_message(content) == TextEntry(content)
+
+
+def test_validate_period():
+    assert validate_period('3:0:0') == 3 * 60**2
+    assert validate_period(' 2 : 30 : 15 ') == 2 * 60**2 + 30 * 60 + 15
+    assert validate_period('3:0') is None
+    assert validate_period('3h') is None
+    assert format_period(validate_period('2:30:0')) == '2 часов 30 минут'
+
+
+def test_validate_delta():
+    assert validate_delta('-1h') == -HOUR
+    assert validate_delta('15m') == datetime.timedelta(minutes=15)
+    assert validate_delta('-1d') is None
+    assert validate_delta('h') is None
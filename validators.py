@@ -1,5 +1,11 @@
+import re
 import datetime
-import time
+import logging
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
+
+
 #def validate_period2(content):
 #    try:
 #        segments = []
@@ -28,18 +34,42 @@ import time
 #assert validate_period('1h') == 60**2
 #assert validate_period('2h3m25s') == 2 * 60**2 + 3*60 + 25
 
-def silent_errors(func):
-    def wrapper(*args, **kwargs):
-        try:
-            return func(*args, **kwargs)
-        except:
-            pass
-    return wrapper
+_INT = r'[+-]?\d+'
+_PERIOD = re.compile(r'\s*({i})\s*:\s*({i})\s*:\s*({i})\s*'.format(i=_INT))
+_DELTA = re.compile(r'\s*({i})\s*([hm])'.format(i=_INT))
+_MESSAGE = re.compile(r"""\s*(?:
+    (?P<amount>{i})                                         # 120
+  | (?P<delta>{i})(?P<unit>[hm])\ (?P<delayed_amount>{i})   # -1h 120
+)\s*""".format(i=_INT), re.X)
+
+_UNITS = {'h': 60 * 60, 'm': 60}
+
+# what parse_message makes of a plain message
+MealEntry = namedtuple('MealEntry', 'amount delta')
+TextEntry = namedtuple('TextEntry', 'text')
+
+
+def _seconds(hours, minutes, seconds):
+    return int(hours) * 60**2 + int(minutes) * 60 + int(seconds)
+
+
+def parse_message(content):
+    """Classifies a message in one pass: a meal ('120', or '-1h 120' for one
+    an hour ago) or anything else."""
+    match = _MESSAGE.fullmatch(content)
+    if match is None:
+        return TextEntry(content)
+    if match['amount'] is not None:
+        return MealEntry(int(match['amount']), datetime.timedelta())
+    delta = datetime.timedelta(seconds=int(match['delta']) * _UNITS[match['unit']])
+    return MealEntry(int(match['delayed_amount']), delta)
+
 
-@silent_errors
 def validate_period(period):
-    h,m,s = period.split(':')
-    return int(h) * 60**2 + int(m)*60 + int(s)
+    match = _PERIOD.fullmatch(period)
+    if match is None:
+        return None
+    return _seconds(*match.groups())
 
 
 def format_period(seconds):
@@ -56,52 +86,14 @@ def format_period(seconds):
         result += ' %d секунд' % (seconds,)
     return result.strip()
 
-@silent_errors
+
 def validate_delta(tp):
-    if tp.endswith('h'):
-        return datetime.timedelta(hours=int(tp[:-1]))
-    elif tp.endswith('m'):
-        return datetime.timedelta(minutes=int(tp[:-1]))
-    else:
+    match = _DELTA.fullmatch(tp)
+    if match is None:
         return None
-
-def validate_time_and_meal(now, content):
-    try:
-        tp, amount = content.split(' ')
-        amount = int(amount)
-    
-        tp = now + validate_delta(tp)
-
-        return tp, amount
-    except Exception as e:
-        print(e)
-        return None, None
-
-
-@silent_errors
-def validate_meal(content):
-    return int(content)
+    return datetime.timedelta(seconds=int(match[1]) * _UNITS[match[2]])
 
 
 def format_time(dt):
     return str(dt)
 
-
-@silent_errors
-def validate_time_with_year(content):
-    conv=time.strptime(content,"%b %d %Y")
-    return datetime.datetime.fromtimestamp(time.mktime(conv), tz=datetime.timezone.utc)
-
-
-@silent_errors
-def validate_time(content):
-    result = validate_time_with_year(content)
-    if result is not None:
-        return result
-    else:
-        return validate_time_with_year(content + ' ' + str(datetime.datetime.utcnow().year))
-
-assert validate_time('Feb 8') is not None
-assert validate_time('Apr 8') is not None
-assert validate_delta('-1h') is not None
-assert validate_delta('-1m') is not None
@@ -0,0 +1,120 @@
+import os
+import hmac
+import json
+import signal
+import asyncio
+import logging
+from telegram import Update
+
+log = logging.getLogger(__name__)
+
+WEBHOOK_LISTEN = os.environ.get('NANNYBOT_WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get('NANNYBOT_WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.environ.get('NANNYBOT_WEBHOOK_PATH', '/telegram')
+# public base url to register with Telegram, unset leaves the registered webhook alone
+WEBHOOK_URL = os.environ.get('NANNYBOT_WEBHOOK_URL')
+WEBHOOK_SECRET = os.environ.get('NANNYBOT_WEBHOOK_SECRET')
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('NANNYBOT_WEBHOOK_MAX_CONNECTIONS', 40))
+MAX_BODY = 1 << 20
+
+
+async def _read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY:
+        raise ValueError('request body of %d bytes' % (length,))
+    body = await reader.readexactly(length)
+    return method, path, headers, body
+
+
+def _respond(writer, status, reason):
+    writer.write(b'HTTP/1.1 %d %s\r\nContent-Length: 0\r\n\r\n' % (status, reason))
+
+
+class WebhookServer:
+    """Minimal HTTP/1.1 endpoint Telegram posts updates to.
+
+    Every connection is served by its own task and keeps alive, so Telegram
+    can deliver up to max_connections updates at once. Decoded updates are
+    handed to on_update, which is the application's update queue in
+    production.
+    """
+
+    def __init__(self, bot, on_update, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+        self._bot = bot
+        self._on_update = on_update
+        self._path = path
+        self._secret = secret
+        self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if method != 'POST' or path != self._path:
+                    _respond(writer, 404, b'Not Found')
+                elif self._secret and not hmac.compare_digest(
+                        headers.get('x-telegram-bot-api-secret-token', ''), self._secret):
+                    _respond(writer, 403, b'Forbidden')
+                else:
+                    try:
+                        update = self.decode(body)
+                    except ValueError:
+                        _respond(writer, 400, b'Bad Request')
+                    else:
+                        await self._on_update(update)
+                        _respond(writer, 200, b'OK')
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            log.debug('dropping webhook connection: %s', e)
+        finally:
+            writer.close()
+
+    def decode(self, body):
+        return Update.de_json(json.loads(body), self._bot)
+
+    async def start(self, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        log.info('listening for updates on %s:%d%s', host, port, self._path)
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+
+async def run(app):
+    """Webhook counterpart of app.run_polling()."""
+    server = WebhookServer(app.bot, app.update_queue.put)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with app:
+        if app.post_init is not None:
+            await app.post_init(app)
+        await app.start()
+        await server.start()
+        if WEBHOOK_URL is not None:
+            await app.bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                      max_connections=WEBHOOK_MAX_CONNECTIONS)
+        await stop.wait()
+        await server.stop()
+        await app.stop()
+        if app.post_shutdown is not None:
+            await app.post_shutdown(app)
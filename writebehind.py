@@ -0,0 +1,127 @@
+import os
+import asyncio
+import logging
+from collections import defaultdict
+from sqlalchemy import update, bindparam
+from base import async_session
+
+log = logging.getLogger(__name__)
+
+# 0 writes every row in its own transaction right away
+WRITE_BEHIND_MS = int(os.environ.get('NANNYBOT_WRITE_BEHIND_MS', 0))
+WRITE_BEHIND_ROWS = int(os.environ.get('NANNYBOT_WRITE_BEHIND_ROWS', 500))
+# seconds before a failed flush is tried again, and failed flushes in a row before its rows are dropped
+RETRY_DELAY = 1
+MAX_ATTEMPTS = int(os.environ.get('NANNYBOT_WRITE_BEHIND_ATTEMPTS', 5))
+
+
+@async_session
+def _write(session, inserts, updates):
+    for model, rows in inserts.items():
+        session.bulk_insert_mappings(model, rows)
+    for model, rows in updates.items():
+        table = model.__table__
+        # one executemany per set of columns; unlike bulk_update_mappings()
+        # it does not fail when a row was deleted since, e.g. by /stop
+        by_columns = defaultdict(list)
+        for _id, values in rows.items():
+            by_columns[tuple(sorted(name for name in values if name != 'id'))].append(
+                {'_id': _id, **{name: value for name, value in values.items() if name != 'id'}})
+        for columns, params in by_columns.items():
+            statement = update(table).where(table.c.id == bindparam('_id')) \
+                .values({name: bindparam(name) for name in columns})
+            session.execute(statement, params)
+
+
+class WriteBuffer:
+    """Collects inserts and primary key updates and writes them in one
+    transaction every `delay` ms or `max_rows` rows.
+
+    Code that reads tables written through the buffer awaits flush() first,
+    flushing an empty buffer costs nothing. Only flush() raises: once a
+    row is queued a failed write is logged and retried later, after
+    MAX_ATTEMPTS failures in a row the rows are logged and dropped.
+    """
+
+    def __init__(self, delay=WRITE_BEHIND_MS, max_rows=WRITE_BEHIND_ROWS):
+        self._delay = delay / 1000
+        self._max_rows = max_rows
+        self._inserts = defaultdict(list)
+        self._updates = defaultdict(dict)
+        self._rows = 0
+        self._timer = None
+        self._task = None
+        self._failures = 0
+        self._lock = asyncio.Lock()
+
+    async def add(self, inserts=(), updates=()):
+        """Queues (model, values) inserts and (model, id, values) updates
+        together, so they end up in the same transaction."""
+        for model, values in inserts:
+            self._inserts[model].append(values)
+        for model, _id, values in updates:
+            # later updates of the same row win
+            self._updates[model].setdefault(_id, {'id': _id}).update(values)
+        await self._added(len(inserts) + len(updates))
+
+    async def insert(self, model, **values):
+        await self.add(inserts=[(model, values)])
+
+    async def update(self, model, _id, **values):
+        await self.add(updates=[(model, _id, values)])
+
+    async def _added(self, rows):
+        self._rows += rows
+        if self._delay == 0 or self._rows >= self._max_rows:
+            await self._try_flush()
+        else:
+            self._arm(self._delay)
+
+    def _arm(self, delay):
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(delay, self._fire)
+
+    def _fire(self):
+        self._timer = None
+        self._task = asyncio.ensure_future(self._try_flush())
+
+    async def _try_flush(self):
+        try:
+            await self.flush()
+        except Exception:
+            # flush() logged it and kept the rows
+            self._arm(max(self._delay, RETRY_DELAY))
+
+    async def flush(self):
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._rows == 0:
+                return
+            inserts, updates = self._inserts, self._updates
+            self._inserts, self._updates = defaultdict(list), defaultdict(dict)
+            self._rows = 0
+            try:
+                await _write(inserts, updates)
+            except Exception:
+                self._failures += 1
+                if self._failures < MAX_ATTEMPTS:
+                    log.exception('write-behind flush failed, keeping rows')
+                    self._requeue(inserts, updates)
+                else:
+                    # the rows left in the log are all that is left of them
+                    log.exception('write-behind flush failed %d times, dropping inserts %r and updates %r',
+                                  self._failures, dict(inserts), dict(updates))
+                    self._failures = 0
+                raise
+            self._failures = 0
+
+    def _requeue(self, inserts, updates):
+        for model, rows in inserts.items():
+            self._inserts[model][:0] = rows
+            self._rows += len(rows)
+        for model, rows in updates.items():
+            for _id, values in rows.items():
+                self._updates[model][_id] = {**values, **self._updates[model].get(_id, {})}
+            self._rows += len(rows)